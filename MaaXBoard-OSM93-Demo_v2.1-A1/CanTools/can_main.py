@@ -12,10 +12,9 @@ CAN_BAUD=500000
 
 class CanDemoManager():
 
-    # setup the can0 on board
-    setup_can0()
-
     def __init__(self, selectedDemo): 
+        # setup the can0 on board, not at import: the spawned inference workers import it too
+        setup_can0()
         self.selectedDemo = selectedDemo # Does nothing, to be used in the future to isolate CAN demo operations while other demos running
         self.can_bus_manager = CanBusManager(can_channel=CAN_CHANNEL, can_interface=CAN_INTERFACE, can_baud=CAN_BAUD)
         self.car_state = CarStatus.IDLE
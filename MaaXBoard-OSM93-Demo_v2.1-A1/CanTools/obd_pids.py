@@ -0,0 +1,147 @@
+"""
+OBD-II PID encoders of the simulated ECU.
+
+Formulas from https://en.wikipedia.org/wiki/OBD-II_PIDs. Every encoder gets
+the CanBusManager holding the car state and the 8 byte response data, and
+writes its value bytes from data[3] on; data[0:3] (length, mode + 0x40, PID)
+and the padding are filled in once when the response message is created.
+"""
+
+import time
+from random import randrange
+
+MODE_CURRENT_DATA = 0x01
+RESPONSE_OFFSET = 0x40
+FRAME_LENGTH = 8
+
+# PID 0100 responses of a Toyota hybrid (found on stackoverflow), two ECUs answer
+PID_0100_RESPONSES = (
+    b'\x06\x41\x00\x98\x3A\x80\x13',
+    b'\x06\x41\x00\xBE\x3F\xA8\x13',
+)
+
+
+def clamp_byte(value):
+    return min(max(int(value), 0), 0xFF)
+
+
+def write_word(data, value):
+    value = min(max(int(value), 0), 0xFFFF)
+    data[3] = value >> 8
+    data[4] = value & 0xFF
+
+
+def encode_monitor_status(car, data):
+    # 0101: MIL off, no DTCs, spark ignition with misfire, fuel system and component monitors complete
+    data[3:7] = b'\x00\x07\x65\x00'
+
+
+def encode_fuel_system_status(car, data):
+    # 0103: fuel system 1 in closed loop, no fuel system 2
+    data[3] = 0x02
+    data[4] = 0x00
+
+
+def encode_engine_load(car, data):
+    # 0104: load % = 100 / 255 * A
+    data[3] = clamp_byte(randrange(0, 101) / 100 * 255)
+
+
+def encode_coolant_temp(car, data):
+    # 0105: temp C = A - 40
+    data[3] = randrange(-40, 126) + 40
+
+
+def encode_fuel_trim(car, data):
+    # 0106 / 0107: trim % = 100 / 128 * A - 100
+    data[3] = clamp_byte((randrange(-5, 6) + 100) * 128 / 100)
+
+
+def encode_intake_manifold_pressure(car, data):
+    # 010B: kPa = A
+    data[3] = randrange(20, 100)
+
+
+def encode_rpm(car, data):
+    # 010C: rpm = (256 * A + B) / 4
+    write_word(data, car.car_rpm * 4)
+
+
+def encode_speed(car, data):
+    # 010D: km/h = A, the car speed is in mph
+    data[3] = clamp_byte(car.car_speed * 1.61)  # not completely accurate for mph, but close enough
+
+
+def encode_timing_advance(car, data):
+    # 010E: degrees before TDC = A / 2 - 64
+    data[3] = (randrange(0, 21) + 64) * 2
+
+
+def encode_intake_air_temp(car, data):
+    # 010F: temp C = A - 40
+    data[3] = randrange(-40, 121) + 40
+
+
+def encode_maf_rate(car, data):
+    # 0110: g/s = (256 * A + B) / 100, roughly following the rpm
+    write_word(data, car.car_rpm / 200 * 100)
+
+
+def encode_throttle_position(car, data):
+    # 0111: throttle % = 100 / 255 * A
+    data[3] = clamp_byte(car.car_throttle_pos / 100 * 255)
+
+
+def encode_oxygen_sensors_present(car, data):
+    # 0113: bank 1 sensors 1 and 2
+    data[3] = 0x03
+
+
+def encode_oxygen_sensor_2(car, data):
+    # 0115: volts = A / 200, B = 0xFF as the sensor is not used for trim
+    data[3] = randrange(10, 180)
+    data[4] = 0xFF
+
+
+def encode_obd_standard(car, data):
+    # 011C: 1 = OBD-II as defined by the CARB
+    data[3] = 0x01
+
+
+def encode_run_time(car, data):
+    # 011F: seconds since engine start = 256 * A + B
+    write_word(data, time.monotonic() - car.start_time)
+
+
+# mode 01 PID -> (data bytes, encoder), covering all PIDs announced in PID_0100_RESPONSES
+MODE_01_PIDS = {
+    0x01: (4, encode_monitor_status),
+    0x03: (2, encode_fuel_system_status),
+    0x04: (1, encode_engine_load),
+    0x05: (1, encode_coolant_temp),
+    0x06: (1, encode_fuel_trim),
+    0x07: (1, encode_fuel_trim),
+    0x0B: (1, encode_intake_manifold_pressure),
+    0x0C: (2, encode_rpm),
+    0x0D: (1, encode_speed),
+    0x0E: (1, encode_timing_advance),
+    0x0F: (1, encode_intake_air_temp),
+    0x10: (2, encode_maf_rate),
+    0x11: (1, encode_throttle_position),
+    0x13: (1, encode_oxygen_sensors_present),
+    0x15: (2, encode_oxygen_sensor_2),
+    0x1C: (1, encode_obd_standard),
+    0x1F: (2, encode_run_time),
+}
+
+
+def supported_pids_bitmap(pids, base):
+    """
+    Value of the supported PIDs request base (0x20, 0x40, ...): bit 31 is
+    PID base + 1, bit 0 is PID base + 0x20
+    """
+    bitmap = 0
+    for pid in pids:
+        if base < pid <= base + 0x20:
+            bitmap |= 1 << (base + 0x20 - pid)
+    return bitmap
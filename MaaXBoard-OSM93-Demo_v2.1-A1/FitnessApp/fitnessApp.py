@@ -1,9 +1,12 @@
+import os
 import cv2
 import numpy as np
-import mediapipe as mp
 import math
 import time
 import sys
+import threading
+import functools
+import multiprocessing
 
 
 BICEP_CURL_POINTS = [11,13,15]
@@ -26,28 +29,170 @@ CONF_THRESHOLD = 0.6
 EXERCISE_REPS = 0
 EXERCISE_SETS = 1
 
-def init_fitness_app():
+KEYPOINT_NUM = 33
+
+# pose estimation backend: "mediapipe" (CPU), "mediapipe_process" (MediaPipe in a
+# worker process), "movenet" (int8 MoveNet on the CPU) or "movenet_npu" (Vela
+# compiled MoveNet on the Ethos-U NPU). With INFERENCE_PROCESS=1 the whole demo
+# already runs in a worker process, use "mediapipe" there.
+POSE_BACKENDS = ("mediapipe", "mediapipe_process", "movenet", "movenet_npu")
+POSE_BACKEND = os.environ.get("FITNESS_POSE_BACKEND", "mediapipe")
+
+# MediaPipe pose settings, lower complexity trades accuracy for frame rate:
+# model_complexity 0 (lite), 1 (full) or 2 (heavy), smooth_landmarks filters
+# landmarks across frames, tracking reuses the previous pose as the region of
+# interest instead of running the person detector on every frame
+POSE_CONFIG = {
+    "model_complexity": int(os.environ.get("FITNESS_MODEL_COMPLEXITY", "1")),
+    "smooth_landmarks": os.environ.get("FITNESS_SMOOTHING", "1") == "1",
+    "tracking": os.environ.get("FITNESS_TRACKING", "1") == "1",
+}
+
+# FITNESS_RECORD=<file> records the pose keypoints of the fitness demo for
+# replay with python3 -m FitnessApp.keypoint_recording <file>
+RECORD_PATH = os.environ.get("FITNESS_RECORD")
+
+fitness_app = None
+fitness_app_lock = threading.Lock()
+
+def init_fitness_app(pose_backend=None, pose_config=None):
     global fitness_app
-    fitness_app = FitnessAI()
+    app = FitnessAI(pose_backend or POSE_BACKEND, pose_config)
+    with fitness_app_lock:
+        fitness_app = app
+
+def get_fitness_app():
+    """The fitness app, created with the configured pose backend on first use"""
+    global fitness_app
+    with fitness_app_lock:
+        if fitness_app is None:
+            fitness_app = FitnessAI(POSE_BACKEND, POSE_CONFIG)
+            if RECORD_PATH:
+                fitness_app.start_recording(RECORD_PATH)
+        return fitness_app
+
+def prewarm_fitness_app():
+    """Create the fitness app on a background thread so the first frame does not wait"""
+    if fitness_app is not None:
+        return None
+    thread = threading.Thread(target=get_fitness_app, daemon=True)
+    thread.start()
+    return thread
+
+def create_pose_detector(pose_backend, pose_config=None):
+    if pose_backend is None:
+        # keypoints are fed with process_keypoints, e.g. from a recording
+        return None
+    if pose_backend not in POSE_BACKENDS:
+        raise ValueError("pose backend must be one of " + ", ".join(POSE_BACKENDS))
+    if pose_config is None:
+        pose_config = POSE_CONFIG
+    if pose_backend == "mediapipe":
+        return PoseDetector(**pose_config)
+    if pose_backend == "mediapipe_process":
+        if multiprocessing.current_process().daemon:
+            # already in the inference worker, which cannot start processes of its own
+            return PoseDetector(**pose_config)
+        return ProcessPoseDetector(pose_config)
+    # MoveNet keypoints are mapped to the MediaPipe landmark layout the exercises use
+    from PostureModel.posture_detect import PostureDetector
+    return PostureDetector(vela=pose_backend == "movenet_npu", run_on_hardware=True)
+
+def create_keypoints():
+    """(33, 4) array of [idx, cx, cy, confidence] rows, one per MediaPipe landmark"""
+    keypoints = np.zeros((KEYPOINT_NUM, 4), dtype=np.float32)
+    keypoints[:, 0] = np.arange(KEYPOINT_NUM)
+    return keypoints
 
 class PoseDetector:
-    def __init__(self):
+    def __init__(self, model_complexity=1, smooth_landmarks=True, tracking=True,
+                 min_detection_confidence=0.5, min_tracking_confidence=0.5):
+        import mediapipe as mp
         self.mpPose = mp.solutions.pose
-        self.pose = self.mpPose.Pose()
+        self.pose = self.mpPose.Pose(static_image_mode=not tracking,
+                                     model_complexity=model_complexity,
+                                     smooth_landmarks=smooth_landmarks,
+                                     min_detection_confidence=min_detection_confidence,
+                                     min_tracking_confidence=min_tracking_confidence)
+        self.keypoints = create_keypoints()
     
-    def detect_pose(self, frame):
-        # Convert color BGR to RGB for inferencing
-        imgRGB = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    def detect_pose(self, frame, imgRGB=None):
+        """Returns the (33, 4) keypoints, reused by the next call, or None without a pose"""
+        # Convert color BGR to RGB for inferencing, unless a shared RGB view is given
+        if imgRGB is None:
+            imgRGB = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         results = self.pose.process(imgRGB)
-        keypoint_list = []
-        if results.pose_landmarks:
-            for idx, landmark in enumerate(results.pose_landmarks.landmark):
-                h, w, c = frame.shape
-                confidence = landmark.visibility
-                cx, cy = int(landmark.x * w), int(landmark.y*h)
-                keypoint_list.append([idx, cx, cy, confidence])
-        # print(keypoint_list)
-        return keypoint_list
+        if not results.pose_landmarks:
+            return None
+        h, w, c = frame.shape
+        values = np.array([(landmark.x, landmark.y, landmark.visibility)
+                           for landmark in results.pose_landmarks.landmark], dtype=np.float64)
+        # pixel coordinates are truncated like int() did
+        self.keypoints[:, 1] = np.trunc(values[:, 0] * w)
+        self.keypoints[:, 2] = np.trunc(values[:, 1] * h)
+        self.keypoints[:, 3] = values[:, 2]
+        return self.keypoints
+
+pose_worker = None
+
+def init_pose_worker(pose_config):
+    global pose_worker
+    pose_worker = PoseDetector(**pose_config)
+
+def pose_worker_handler(command, image, *args):
+    # image is the RGB frame in the shared memory slot
+    keypoints = pose_worker.detect_pose(image, image)
+    return keypoints.copy() if keypoints is not None else None
+
+class ProcessPoseDetector:
+    """
+    MediaPipe PoseDetector running in a worker process.
+
+    The RGB frame goes to the worker through shared memory and only the
+    (33, 4) keypoint array comes back, so MediaPipe's Python pre and post
+    processing does not hold the GIL of the UI and web server. The worker is
+    started with the detector, so MediaPipe loads while the app is prewarmed,
+    and restarted if the frame size changes. Until it is ready no pose is
+    detected. close() stops it.
+
+    Arguments:
+    pose_config -- PoseDetector keyword arguments
+    shape -- RGB frame shape
+    """
+    def __init__(self, pose_config, shape=(240, 320, 3)):
+        self.pose_config = dict(pose_config)
+        self.process = None
+        self.keypoints = create_keypoints()
+        self.start(shape)
+
+    def detect_pose(self, frame, imgRGB=None):
+        """Returns the (33, 4) keypoints, reused by the next call, or None without a pose"""
+        if imgRGB is None:
+            imgRGB = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if self.process is None or self.process.shape != imgRGB.shape:
+            self.start(imgRGB.shape)
+        if not self.process.Ready():
+            # MediaPipe still loading, or the worker died and is restarted
+            self.process.EnsureRunning()
+            return None
+        keypoints = self.process.Call("detect", imgRGB)
+        if keypoints is None:
+            return None
+        self.keypoints[:] = keypoints
+        return self.keypoints
+
+    def start(self, shape):
+        from inference_process import InferenceProcess
+        self.close()
+        # spawned, the initializer must be picklable
+        self.process = InferenceProcess(pose_worker_handler, functools.partial(init_pose_worker, self.pose_config),
+                                        slots=2, shape=shape)
+        self.process.Start()
+
+    def close(self):
+        if self.process is not None:
+            self.process.Stop()
+            self.process = None
 
 class Exercise:
     def __init__(self, name, keypoints, angle_range):
@@ -63,65 +208,35 @@ class Exercise:
         self.angle_range = angle_range
         self.status = None
     
-    def check_keypoint_visibility(self, frame, kps):
-        # keypoints from exercise, etc 11, 13, 15
-        p1, p2, p3 = self.keypoints[0],self.keypoints[1],self.keypoints[2]
-
-        # check that keypoints are valid in main list
-        if kps[p1] or kps[p2] or kps[p3]:
-            x1, y1, c1 = kps[p1][1:4]
-            x2, y2, c2 = kps[p2][1:4]
-            x3, y3, c3 = kps[p3][1:4]
-            # check keypoint confidence scores against threshold
-            # check keypoints are within the frame (bound w, h) - not added yet
-            if (c1 < CONF_THRESHOLD or c2 < CONF_THRESHOLD or c3 < CONF_THRESHOLD):
-                self.rom = 0
-                self.status = "Difficulty Detecting Landmarks"
-                return False
-            else:
-                self.status = "Good Landmark Detection"
-                return True
-    
     def draw_connections(self, img, p1, p2, p3):
         cv2.line(img, p1, p2, (255,255,255), 2)
         cv2.line(img, p2, p3, (255,255,255), 2)
         pass 
 
-    def calculate_angle(self, img, kps, draw=True):
-        # print(self.keypoints)
-        # print(kps)
-        p1, p2, p3 = self.keypoints[0],self.keypoints[1],self.keypoints[2]
-
-        # grab x,y for each keypoint 
-        x1, y1 = kps[p1][1:3]
-        x2, y2 = kps[p2][1:3]
-        x3, y3 = kps[p3][1:3]
-
-        # calc angle of 3 points for ROM
-        if self.name == EXERCISE_3: # side lateral
-            self.angle = math.degrees(math.atan2(y1-y2, x1-x2)- math.atan2(y3-y2, x3-x2))
-        else:
-            self.angle = math.degrees(math.atan2(y3-y2, x3-x2) - math.atan2(y1-y2, x1-x2))
-        self.angle = int(self.angle)
-
-        if self.angle < 0:
-            self.angle += 360
-
-        # print(self.angle)
-        if draw:
-            cv2.circle(img, (x1,y1), 15, (0,0,255), 2)
-            cv2.circle(img, (x1,y1), 5, (0,0,255), cv2.FILLED)
-            cv2.circle(img, (x2,y2), 15, (0,0,255), 2)
-            cv2.circle(img, (x2,y2), 5, (0,0,255), cv2.FILLED)
-            cv2.circle(img, (x3,y3), 15, (0,0,255), 2)
-            cv2.circle(img, (x3,y3), 5, (0,0,255), cv2.FILLED)
-            # cv2.putText(img, str(self.angle), (x2-50, y2+50), cv2.FONT_HERSHEY_PLAIN, 2, (255,0,0), 2)
-            
-            self.draw_connections(img, (x1,y1),(x2,y2),(x3,y3))
-
-    def calculate_rom(self):
-        self.rom = int(np.interp(self.angle, self.angle_range, self.rom_range))
-        # print("ROM: ", self.rom)
+    def draw(self, img, kps):
+        # keypoints from exercise, etc 11, 13, 15
+        (x1, y1), (x2, y2), (x3, y3) = kps[self.keypoints, 1:3].astype(int).tolist()
+        cv2.circle(img, (x1,y1), 15, (0,0,255), 2)
+        cv2.circle(img, (x1,y1), 5, (0,0,255), cv2.FILLED)
+        cv2.circle(img, (x2,y2), 15, (0,0,255), 2)
+        cv2.circle(img, (x2,y2), 5, (0,0,255), cv2.FILLED)
+        cv2.circle(img, (x3,y3), 15, (0,0,255), 2)
+        cv2.circle(img, (x3,y3), 5, (0,0,255), cv2.FILLED)
+        # cv2.putText(img, str(self.angle), (x2-50, y2+50), cv2.FONT_HERSHEY_PLAIN, 2, (255,0,0), 2)
+        
+        self.draw_connections(img, (x1,y1),(x2,y2),(x3,y3))
+
+    def update(self, visible, angle, rom):
+        # check keypoint confidence scores against threshold
+        # check keypoints are within the frame (bound w, h) - not added yet
+        if not visible:
+            self.rom = 0
+            self.status = "Difficulty Detecting Landmarks"
+            return
+        self.status = "Good Landmark Detection"
+        self.angle = angle
+        self.rom = rom
+        self.update_rep_count()
 
     def update_rep_count(self):
         # Update rep_count based on rom and direction
@@ -154,31 +269,107 @@ class Exercise:
         cv2.rectangle(image, (1100, int(bar)), (1175, 650), (0, 255, 0), cv2.FILLED)
         pass
 
+class ExerciseBatch:
+    """
+    Visibility, joint angle and ROM of every exercise, computed together.
+
+    The three keypoints of all exercises are gathered from the (33, 4)
+    keypoint array in one indexing operation and evaluated with array math,
+    so adding exercises costs almost nothing per frame. Only the rep counters
+    are updated per exercise.
+    """
+    def __init__(self, exercises, conf_threshold=CONF_THRESHOLD):
+        self.exercises = exercises
+        self.conf_threshold = conf_threshold
+        self.points = np.array([exercise.keypoints for exercise in exercises], dtype=np.intp)
+        # side lateral raise measures the angle the other way round
+        self.reverse = np.array([exercise.name == EXERCISE_3 for exercise in exercises])
+        angle_ranges = np.array([exercise.angle_range for exercise in exercises], dtype=np.float64)
+        rom_ranges = np.array([exercise.rom_range for exercise in exercises], dtype=np.float64)
+        self.angle_low, self.angle_high = angle_ranges[:, 0], angle_ranges[:, 1]
+        self.rom_low, self.rom_high = rom_ranges[:, 0], rom_ranges[:, 1]
+        self.rom_slope = (self.rom_high - self.rom_low) / (self.angle_high - self.angle_low)
+
+    def evaluate(self, kps):
+        """Returns visible, angle and rom arrays with one entry per exercise"""
+        points = kps[self.points]  # (exercises, 3, 4)
+        visible = (points[:, :, 3] >= self.conf_threshold).all(axis=1)
+
+        xy = points[:, :, 1:3].astype(np.float64)
+        to_first = xy[:, 0] - xy[:, 1]
+        to_last = xy[:, 2] - xy[:, 1]
+        first = np.arctan2(to_first[:, 1], to_first[:, 0])
+        last = np.arctan2(to_last[:, 1], to_last[:, 0])
+        angle = np.trunc(np.degrees(np.where(self.reverse, first - last, last - first)))
+        angle[angle < 0] += 360
+
+        # linear interpolation clamped to the range, as np.interp per exercise
+        clamped = np.clip(angle, self.angle_low, self.angle_high)
+        rom = np.where(angle >= self.angle_high, self.rom_high,
+                       self.rom_slope * (clamped - self.angle_low) + self.rom_low)
+        return visible, angle.astype(int), np.trunc(rom).astype(int)
+
+    def update(self, kps):
+        visible, angles, roms = self.evaluate(kps)
+        for exercise, exercise_visible, angle, rom in zip(self.exercises, visible.tolist(), angles.tolist(), roms.tolist()):
+            exercise.update(exercise_visible, angle, rom)
+        return visible
+
 class FitnessAI:
-    def __init__(self):
-        self.pose_detector = PoseDetector()
+    """
+    pose_backend -- one of POSE_BACKENDS, None to feed keypoints with process_keypoints
+    pose_config -- MediaPipe settings, None for POSE_CONFIG
+    conf_threshold -- keypoint confidence an exercise needs
+    angle_ranges -- angle range overrides by exercise name, e.g. for threshold sweeps
+    """
+    def __init__(self, pose_backend="mediapipe", pose_config=None, conf_threshold=CONF_THRESHOLD, angle_ranges=None):
+        self.pose_backend = pose_backend
+        self.pose_detector = create_pose_detector(pose_backend, pose_config)
         self.exercises = [
             Exercise("Bicep Curls", BICEP_CURL_POINTS, BICEP_CURL_ANGLE_RANGE),
             # Exercise("Overhead Press", OVERHEAD_PRESSL_POINTS, OVERHEAD_PRESSL_ANGLE_RANGE),
             # Exercise("Side Lateral Raise", SIDE_LATERAL_RAISE_POINTS, SIDE_LATERAL_RAISE_RANGE)
         ]
+        for exercise in self.exercises:
+            if angle_ranges and exercise.name in angle_ranges:
+                exercise.angle_range = tuple(angle_ranges[exercise.name])
+        self.exercise_batch = ExerciseBatch(self.exercises, conf_threshold)
         self.current_exercise_index = 0
+        self.recorder = None
+
+    def start_recording(self, path):
+        from FitnessApp.keypoint_recording import KeypointRecorder
+        self.stop_recording()
+        self.recorder = KeypointRecorder(path)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def close(self):
+        """Stops the recording and the pose worker process, if any"""
+        self.stop_recording()
+        close = getattr(self.pose_detector, "close", None)
+        if close is not None:
+            close()
     
-    def run_exercise_actions(self, exercise, frame, keypoint_list):
-        # print("exercise name: ", exercise.name)
-        # check all keypoints have good confidence
-        if (exercise.check_keypoint_visibility(frame, keypoint_list)):
-            exercise.calculate_angle(frame, keypoint_list)
-            exercise.calculate_rom()
-            exercise.update_rep_count()
+    def process_keypoints(self, kps, frame=None):
+        """Updates angle, ROM and reps of every exercise, drawing the current one on frame if given"""
+        # check all keypoints have good confidence, then angle, ROM and reps of every exercise
+        visible = self.exercise_batch.update(kps)
+        if frame is not None and visible[self.current_exercise_index]:
+            self.exercises[self.current_exercise_index].draw(frame, kps)
             # exercise.draw_progress_bar(frame, None, None, None, None)
 
 
-    def start(self, frame):
-        keypoint_list = self.pose_detector.detect_pose(frame)
+    def start(self, frame, imgRGB=None):
+        kps = self.pose_detector.detect_pose(frame, imgRGB)
+        if self.recorder is not None:
+            self.recorder.record(kps, time.monotonic(), frame.shape[1::-1])
         exercise = self.exercises[self.current_exercise_index]
-        if keypoint_list:
-            self.run_exercise_actions(exercise, frame, keypoint_list)
+        if kps is not None:
+            self.process_keypoints(kps, frame)
 
             # cv2.imshow('frame', frame)
         
@@ -207,16 +398,23 @@ class FitnessAI:
         return all(exercise.rep_count == 0 for exercise in self.exercises)
 
 
-def process_frame_fitness(image):
+def process_frame_fitness(image, views=None):
     # image format when sending out - BGR
     # print("Fitness App Image Shape: ", image.shape)
-    image_show, rom, set_count, rep_count, name, status = fitness_app.start(frame=image)
+    # views - optional FrameViews of image, its RGB view is shared with other consumers
+    imgRGB = views.RGB() if views is not None else None
+    image_show, rom, set_count, rep_count, name, status = get_fitness_app().start(frame=image, imgRGB=imgRGB)
     return image_show, rom, set_count, int(rep_count), name, status
 
 def reset_fitness_app():
-    fitness_app.reset()
+    if fitness_app is not None:
+        fitness_app.reset()
 
 
 def fitness_app_exit():
-    fitness_app = None
+    global fitness_app
+    with fitness_app_lock:
+        app, fitness_app = fitness_app, None
+    if app is not None:
+        app.close()
 
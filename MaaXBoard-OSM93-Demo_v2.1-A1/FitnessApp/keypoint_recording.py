@@ -0,0 +1,182 @@
+"""
+Keypoint stream recording and replay for the fitness rep counter.
+
+A recording is a 64 byte header followed by fixed size records of
+(timestamp, valid, (33, 4) keypoints), so it can be memory mapped and
+replayed without a camera or pose model, e.g. for rep counter regression
+tests and threshold sweeps:
+
+    python3 -m FitnessApp.keypoint_recording session.kpr --range "Bicep Curls=200,300"
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import threading
+import numpy as np
+
+MAGIC = b"KPTSREC1"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIQ")  # magic, version, keypoints, width, height, frames
+HEADER_SIZE = 64
+KEYPOINT_NUM = 33
+
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("valid", "<u4"),
+    ("keypoints", "<f4", (KEYPOINT_NUM, 4)),
+])
+
+
+class KeypointRecorder:
+    """
+    Appends per frame keypoint arrays and timestamps to a recording file.
+
+    Frames without a pose are stored with valid 0 so the replay sees the same
+    gaps as the live app. Every record is flushed as it is written, as the
+    recorder may live in a worker process that exits without flushing its
+    buffers. The header frame count is updated on close; readers derive the
+    count from the file size, so a recording that was not closed cleanly is
+    still readable.
+
+    Arguments:
+    path -- recording file, overwritten
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.frames = 0
+        self.frame_size = (0, 0)
+        self.record_buffer = np.zeros(1, dtype=RECORD_DTYPE)
+        self.lock = threading.Lock()
+        self.write_header()
+
+    def write_header(self):
+        header = HEADER.pack(MAGIC, VERSION, KEYPOINT_NUM, self.frame_size[0], self.frame_size[1], self.frames)
+        self.file.seek(0)
+        self.file.write(header.ljust(HEADER_SIZE, b"\0"))
+
+    def record(self, keypoints, timestamp, frame_size=None):
+        """keypoints -- (33, 4) array or None without a pose, frame_size -- (width, height)"""
+        with self.lock:
+            if self.file is None:
+                return
+            if frame_size is not None and self.frames == 0:
+                self.frame_size = tuple(int(s) for s in frame_size)
+            record = self.record_buffer
+            record["timestamp"] = timestamp
+            record["valid"] = keypoints is not None
+            record["keypoints"] = keypoints if keypoints is not None else 0
+            self.file.write(self.record_buffer.tobytes())
+            self.file.flush()
+            self.frames += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.write_header()
+            self.file.close()
+            self.file = None
+
+
+class KeypointRecording:
+    """
+    Read only, memory mapped view of a recording.
+
+    Attributes:
+    records -- structured array with timestamp, valid and keypoints fields
+    frame_size -- (width, height) of the recorded frames
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            magic, version, keypoint_num, width, height, _ = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or keypoint_num != KEYPOINT_NUM:
+            raise ValueError("{} is not a keypoint recording".format(path))
+        self.path = path
+        self.frame_size = (width, height)
+        frames = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+        if frames > 0:
+            self.records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE, shape=(frames,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def duration(self):
+        if len(self.records) < 2:
+            return 0.0
+        return float(self.records["timestamp"][-1] - self.records["timestamp"][0])
+
+
+def replay(recording, fitness_ai, speed=None, callback=None):
+    """
+    Drives fitness_ai's rep counters from a recording, without a pose model
+
+    Arguments:
+    recording -- KeypointRecording or path
+    fitness_ai -- FitnessAI to update, e.g. FitnessAI(pose_backend=None)
+    speed -- multiple of real time to replay at, None for as fast as possible
+    callback -- called with (index, fitness_ai) after every frame
+    """
+    if not isinstance(recording, KeypointRecording):
+        recording = KeypointRecording(recording)
+    records = recording.records
+    if len(records) == 0:
+        return fitness_ai
+
+    timestamps = np.asarray(records["timestamp"])
+    valid = np.asarray(records["valid"]).astype(bool)
+    keypoints = np.array(records["keypoints"])
+    start = time.monotonic()
+    for i in range(len(records)):
+        if speed:
+            delay = (timestamps[i] - timestamps[0]) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        if valid[i]:
+            fitness_ai.process_keypoints(keypoints[i])
+        if callback is not None:
+            callback(i, fitness_ai)
+    return fitness_ai
+
+
+def parse_range(text):
+    name, values = text.rsplit("=", 1)
+    low, high = (float(value) for value in values.split(","))
+    return name, (low, high)
+
+
+def main(argv=None):
+    from FitnessApp.fitnessApp import FitnessAI, CONF_THRESHOLD
+
+    parser = argparse.ArgumentParser(description="Replay a keypoint recording through the fitness rep counters")
+    parser.add_argument("recording", help="recording written with FITNESS_RECORD")
+    parser.add_argument("--speed", type=float, default=None, help="multiple of real time, default as fast as possible")
+    parser.add_argument("--range", action="append", default=[], type=parse_range,
+                        help="override an exercise angle range, e.g. \"Bicep Curls=200,300\"")
+    parser.add_argument("--conf", type=float, default=CONF_THRESHOLD, help="keypoint confidence threshold")
+    args = parser.parse_args(argv)
+
+    recording = KeypointRecording(args.recording)
+    fitness_ai = FitnessAI(pose_backend=None, conf_threshold=args.conf, angle_ranges=dict(args.range))
+    start = time.perf_counter()
+    replay(recording, fitness_ai, args.speed)
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        "frames": len(recording),
+        "recorded_s": round(recording.duration(), 3),
+        "replay_s": round(elapsed, 4),
+        "exercises": {exercise.name: {"reps": exercise.rep_count, "angle_range": list(exercise.angle_range)}
+                      for exercise in fitness_ai.exercises},
+    }, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
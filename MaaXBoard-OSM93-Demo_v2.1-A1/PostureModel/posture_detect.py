@@ -1,20 +1,52 @@
+import os
 import math
 import cv2
 import numpy as np
-#import tflite_runtime.interpreter as tflite
-import tensorflow as tf
+from dms import model_paths
+from dms.model_runner import ModelRunner
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+
+POSTURE_MODELS = {
+    'int8': 'lite-model_movenet_singlepose_lightning_tflite_int8_4.tflite',
+    'vela': 'lite-model_movenet_singlepose_lightning_tflite_int8_4_vela.tflite'
+}
+
+# MoveNet keypoint index -> MediaPipe Pose landmark index
+MOVENET_TO_MEDIAPIPE = np.array([
+    0,       # nose
+    2, 5,    # left/right eye
+    7, 8,    # left/right ear
+    11, 12,  # left/right shoulder
+    13, 14,  # left/right elbow
+    15, 16,  # left/right wrist
+    23, 24,  # left/right hip
+    25, 26,  # left/right knee
+    27, 28   # left/right ankle
+])
+MEDIAPIPE_KEYPOINT_NUM = 33
 
 class PostureDetector:
-    
-    def __init__(self, model_path):
-        self.interpreter = tf.lite.Interpreter(model_path=model_path)
-        self.interpreter.allocate_tensors()
-        self.input_idx = self.interpreter.get_input_details()[0]['index']
-        self.input_shape = self.interpreter.get_input_details()[0]['shape'][1:3]
+    """
+    MoveNet single pose detector, the interpreter is created once and reused.
 
-        outputs_idx_tmp = {}
-        for output in self.interpreter.get_output_details():
-            outputs_idx_tmp[output['name']] = output['index']
+    Arguments:
+    model_path -- path to the .tflite model, None for the bundled variant
+    vela -- use the Vela compiled variant on the Ethos-U NPU instead of the int8 CPU one
+    delegate_path -- external delegate, defaults to the Ethos-U delegate for the Vela variant
+    run_on_hardware -- use tflite_runtime instead of tensorflow.lite
+    """
+    
+    def __init__(self, model_path=None, vela=False, delegate_path=None, run_on_hardware=False):
+        if model_path is None:
+            model_path = os.path.join(MODEL_DIR, POSTURE_MODELS['vela' if vela else 'int8'])
+        if vela and delegate_path is None:
+            delegate_path = model_paths.NPU_DELEGATE
+        self.runner = ModelRunner("posture", model_path, delegate_path, run_on_hardware)
+        self.input_shape = self.runner.input_shape
+        self.resized = np.empty((*self.input_shape, 3), dtype=np.uint8)
+        self.keypoints = np.zeros((MEDIAPIPE_KEYPOINT_NUM, 4), dtype=np.float32)
+        self.keypoints[:, 0] = np.arange(MEDIAPIPE_KEYPOINT_NUM)
 
     def movenet(self, input_image):
         """Runs detection on an input image.
@@ -36,19 +68,38 @@ class PostureDetector:
         # 1.) grab expected input tensor dimensions for image
         # 2.) pre-process & resize the image with cv2 
         # 3.) expand dimensions of the input_image array data to match tensor requirements
-        dims = (self.input_shape[0], self.input_shape[1])
-        input_image = cv2.resize(input_image, dims)
-        input_image = np.expand_dims(input_image, axis=0)
+        dims = (self.input_shape[1], self.input_shape[0])
+        input_image = cv2.resize(input_image, dims, dst=self.resized)
 
 
-        input_details = self.interpreter.get_input_details()
-        output_details = self.interpreter.get_output_details()
-        self.interpreter.set_tensor(input_details[0]['index'], input_image)
+        # the input view must be released before invoking
+        input_view = self.runner.input_views[0]()
+        input_view[0] = input_image
+        del input_view
         # Invoke inference. 
-        self.interpreter.invoke()
+        self.runner.invoke()
         # Get the model prediction.
-        keypoints_with_scores = self.interpreter.get_tensor(output_details[0]['index'])
+        keypoints_with_scores = self.runner.output_at(0).copy()
         return keypoints_with_scores
+
+    def detect_pose(self, frame, imgRGB=None):
+        """
+        Same interface and keypoint format as the MediaPipe PoseDetector of the fitness app
+
+        Returns a (33, 4) array of [idx, cx, cy, confidence] rows for the
+        MediaPipe landmarks, in pixels of frame, reused by the next call.
+        Landmarks MoveNet does not detect (hands, feet, face details) have
+        confidence 0.
+        """
+        if imgRGB is None:
+            imgRGB = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        keypoints = self.movenet(imgRGB)[0, 0].astype(np.float64)
+
+        h, w = frame.shape[:2]
+        self.keypoints[MOVENET_TO_MEDIAPIPE, 1] = np.trunc(keypoints[:, 1] * w)
+        self.keypoints[MOVENET_TO_MEDIAPIPE, 2] = np.trunc(keypoints[:, 0] * h)
+        self.keypoints[MOVENET_TO_MEDIAPIPE, 3] = keypoints[:, 2]
+        return self.keypoints
     
 
 
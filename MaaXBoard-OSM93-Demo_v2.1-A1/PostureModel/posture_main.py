@@ -7,7 +7,6 @@
 # https://colab.research.google.com/github/tensorflow/docs/blob/master/site/en/hub/tutorials/movenet.ipynb#scrollTo=zeGHgANcT7a1
 
 
-import pathlib
 import sys
 import time
 import argparse
@@ -18,12 +17,8 @@ from PostureModel.posture_detect import PostureDetector
 
 class posture_core:
     def __init__(self, cap, vela=False):
-        if vela:
-            self.MODEL_PATH = pathlib.Path("D:\Projects\93EVK\PostureModelWebServer\models")
-            self.POSTURE_MODEL = "lite-model_movenet_singlepose_lightning_tflite_int8_4_vela.tflite"
-        else:
-            self.MODEL_PATH = pathlib.Path("D:\Projects\93EVK\PostureModelWebServer\models")
-            self.POSTURE_MODEL = "lite-model_movenet_singlepose_lightning_tflite_int8_4.tflite"
+        # interpreter is created once, models are found next to posture_detect.py
+        self.posture_detector = PostureDetector(vela=vela)
 
         #self.cap = cap
         #ret, image = self.cap.read()
@@ -100,8 +95,7 @@ class posture_core:
                 cv2.circle(frame, (int(kx), int(ky)), 4, (0,255,0), -1) 
 
     def main(self, image):
-        posture_detector = PostureDetector(model_path=str((self.MODEL_PATH / self.POSTURE_MODEL)))
-        keypoints = posture_detector.movenet(image)
+        keypoints = self.posture_detector.movenet(image)
         self.draw_connections(image, keypoints, self.KEYPOINT_EDGE_INDS_TO_COLOR, 0.3)
         self.draw_keypoints(image, keypoints, 0.3)
         return image
@@ -0,0 +1,92 @@
+"""
+Runner Auto-Tune.
+
+Benchmarks every model of the DMS and posture demos on this board for each
+CPU thread count and CPU kernel choice (XNNPACK or the builtin kernels), and
+writes the fastest settings per model and backend to the runner config
+(dms/models-A1/runner_config.json) that ModelRunner reads at load time.
+NPU models are tuned too, their thread count still drives the ops that fall
+back to the CPU.
+
+Example:
+	python3 autotune.py --iterations 30
+"""
+
+import os
+import sys
+import json
+import argparse
+
+from dms import model_paths
+from dms.model_placement import benchmark_model
+from dms.model_runner import CPU_DELEGATES, load_runner_config, save_runner_config
+
+POSTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "PostureModel", "models")
+POSTURE_MODELS = {
+	"CPU": "lite-model_movenet_singlepose_lightning_tflite_int8_4.tflite",
+	"NPU": "lite-model_movenet_singlepose_lightning_tflite_int8_4_vela.tflite",
+}
+
+
+def tunedModels(backends):
+	''' Yields (name, backend, model_path, delegate_path) of every model to tune. '''
+	for backend in backends:
+		for key, name in model_paths.MODEL_NAMES.items():
+			yield name, backend, model_paths.MODEL_DIR + model_paths.MODELS[backend][key], model_paths.DELEGATES[backend]
+		yield "posture", backend, os.path.join(POSTURE_DIR, POSTURE_MODELS[backend]), model_paths.DELEGATES[backend]
+
+
+def tuneModel(modelPath, delegatePath, maxThreads, iterations):
+	''' Returns (best settings, ms of every candidate), or (None, {}) if the model cannot run. '''
+	# the NPU delegate replaces the CPU kernels, only its fallback threads matter
+	cpuDelegates = CPU_DELEGATES if not delegatePath else ("xnnpack",)
+	results = {}
+	for cpuDelegate in cpuDelegates:
+		for threads in range(1, maxThreads + 1):
+			ms = benchmark_model(modelPath, delegatePath, True, iterations=iterations,
+								 num_threads=threads, cpu_delegate=cpuDelegate)
+			if ms is not None:
+				results[(threads, cpuDelegate)] = ms
+
+	if not results:
+		return None, {}
+	threads, cpuDelegate = min(results, key=results.get)
+	best = {"num_threads": threads, "cpu_delegate": cpuDelegate, "ms": round(results[(threads, cpuDelegate)], 3)}
+	return best, {"{}/{}".format(d, t): round(ms, 3) for (t, d), ms in results.items()}
+
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description="Pick the fastest thread count and CPU kernels per model")
+	parser.add_argument("--max-threads", type=int, default=os.cpu_count() or 1, help="highest thread count to try (default: CPU count)")
+	parser.add_argument("--iterations", type=int, default=20, help="timed invokes per candidate")
+	parser.add_argument("--models", nargs="*", help="model names to tune (default: all)")
+	parser.add_argument("--output", default=model_paths.RUNNER_CONFIG, help="runner config to update")
+	parser.add_argument("--dry-run", action="store_true", help="print the results without writing the config")
+	args = parser.parse_args(argv)
+
+	backends = ["CPU"]
+	if os.path.exists(model_paths.NPU_DELEGATE):
+		backends.append("NPU")
+
+	config = load_runner_config(args.output)
+	report = {}
+	for name, backend, modelPath, delegatePath in tunedModels(backends):
+		if args.models and name not in args.models:
+			continue
+		best, candidates = tuneModel(modelPath, delegatePath, args.max_threads, args.iterations)
+		report.setdefault(name, {})[backend] = {"best": best, "candidates_ms": candidates}
+		if best is None:
+			print("{} ({}): cannot run {}".format(name, backend, os.path.basename(modelPath)))
+			continue
+		print("{} ({}): {} threads, {}, {:.2f} ms".format(name, backend, best["num_threads"], best["cpu_delegate"], best["ms"]))
+		config.setdefault(name, {}).setdefault(backend, {}).update(best)
+
+	print(json.dumps(report, indent=2))
+	if not args.dry_run:
+		save_runner_config(config, args.output)
+		print("Runner config written to " + args.output)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Offline Benchmark.
+
+Feeds a video file, an image directory or synthetic frames through the DMS
+and fitness frame processing exactly as the camera pipeline does (resize to
+320x240, then process_frame_dms / process_frame_fitness), without GTK or the
+web server.
+Reports per-stage and end-to-end latency percentiles, sustained FPS, CPU time
+and peak RSS as JSON so runs can be compared between releases. The input frames
+are held in memory, so peak RSS is reported above the RSS once they are loaded.
+
+Example:
+	python3 benchmark.py --input web/sample.mp4 --demo dms --npu --output dms_npu.json
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import cv2
+
+from dms.inference_timer import InferenceTimeLogger, LatencyHistogram
+from frame_source import CreateFrameSource
+
+FRAME_WIDTH = 320
+FRAME_HEIGHT = 240
+SAMPLE_VIDEO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "web", "sample.mp4")
+
+
+def loadFrames(path, maxFrames):
+	''' Decodes the input up front so decode time does not pollute the measurements. '''
+	# fps 0 reads as fast as frames decode, loop off stops at the end of the input
+	source = CreateFrameSource(path, fps=0, loop=False)
+	if not source.Open():
+		raise IOError("Cannot open " + path)
+	frames = []
+	try:
+		while not maxFrames or len(frames) < maxFrames:
+			image, _ = source.Read()
+			if image is None:
+				break
+			frames.append(image)
+	finally:
+		source.Close()
+	if not frames:
+		raise IOError("No frames found in " + path)
+	return frames
+
+
+def cpuTime():
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	return usage.ru_utime + usage.ru_stime
+
+
+def peakRSSMB():
+	# ru_maxrss is reported in KB on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def runDemo(process, frames, loops, warmup):
+	''' Runs process() over every frame and returns the demo's report.
+
+	Args:
+		process (callable): process_frame_dms or process_frame_fitness.
+		frames (list): Decoded BGR frames.
+		loops (int): Number of passes over the frames.
+		warmup (int): Untimed frames processed before measuring.
+	'''
+	for image in frames[:warmup]:
+		process(cv2.resize(image, (FRAME_WIDTH, FRAME_HEIGHT), interpolation=cv2.INTER_AREA))
+
+	total = len(frames) * loops
+	stages = {stage: LatencyHistogram(total) for stage in ("preprocess", "inference", "end_to_end")}
+
+	cpuStart = cpuTime()
+	start = time.perf_counter()
+	for _ in range(loops):
+		for image in frames:
+			t0 = time.perf_counter()
+			resized = cv2.resize(image, (FRAME_WIDTH, FRAME_HEIGHT), interpolation=cv2.INTER_AREA)
+			t1 = time.perf_counter()
+			process(resized)
+			t2 = time.perf_counter()
+			stages["preprocess"].record(t1 - t0)
+			stages["inference"].record(t2 - t1)
+			stages["end_to_end"].record(t2 - t0)
+	elapsed = time.perf_counter() - start
+	cpu = cpuTime() - cpuStart
+
+	return {
+		"frames": total,
+		"wall_s": round(elapsed, 3),
+		"fps": round(total / elapsed, 2),
+		"cpu_s": round(cpu, 3),
+		"cpu_util": round(cpu / elapsed, 2),
+		"stages": {stage: histogram.stats() for stage, histogram in stages.items()},
+	}
+
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description="Offline DMS / fitness pipeline benchmark")
+	parser.add_argument("--input", default=SAMPLE_VIDEO, help="video file, image directory or \"synthetic\" (default: web/sample.mp4)")
+	parser.add_argument("--demo", choices=("dms", "fitness", "all"), default="all")
+	parser.add_argument("--npu", action="store_true", help="run the DMS models on the NPU")
+	parser.add_argument("--frames", type=int, default=300, help="max frames to read from the input, 0 for all (not with synthetic)")
+	parser.add_argument("--loops", type=int, default=1, help="passes over the input")
+	parser.add_argument("--warmup", type=int, default=5, help="untimed frames before measuring")
+	parser.add_argument("--pose-backend", choices=("mediapipe", "mediapipe_process", "movenet", "movenet_npu"), default=None,
+						help="fitness pose backend (default: FITNESS_POSE_BACKEND or mediapipe)")
+	parser.add_argument("--async-smk-call", action="store_true", help="run smoking/calling detection on its worker as in the app")
+	parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+	args = parser.parse_args(argv)
+
+	frames = loadFrames(args.input, args.frames)
+	report = {
+		"input": args.input,
+		"input_frames": len(frames),
+		"loops": args.loops,
+		"npu": args.npu,
+		"demos": {},
+	}
+
+	# frames are cached for the whole run, measure the demos on top of them
+	baselineRSS = peakRSSMB()
+
+	if args.demo in ("dms", "all"):
+		from dms.dms_manager import DMSManager, SMK_CALL_RATE_HZ
+		try:
+			dms = DMSManager(run_on_hardware=True, use_npu=args.npu,
+							 smk_call_rate_hz=SMK_CALL_RATE_HZ if args.async_smk_call else None)
+		except (RuntimeError, ValueError) as e:
+			# e.g. a model file missing from the board
+			print("Cannot benchmark dms: {}".format(e), file=sys.stderr)
+			report["demos"]["dms"] = {"error": str(e)}
+		else:
+			try:
+				report["demos"]["dms"] = runDemo(dms.process_frame_dms, frames, args.loops, args.warmup)
+			finally:
+				dms.close()
+
+	if args.demo in ("fitness", "all"):
+		from FitnessApp.fitnessApp import init_fitness_app, process_frame_fitness
+		init_fitness_app(args.pose_backend)
+		report["demos"]["fitness"] = runDemo(process_frame_fitness, frames, args.loops, args.warmup)
+
+	report["models"] = InferenceTimeLogger().stats()
+	report["frames_rss_mb"] = round(baselineRSS, 1)
+	report["peak_rss_mb"] = round(peakRSSMB() - baselineRSS, 1)
+
+	output = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(output + "\n")
+	else:
+		print(output)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -4,27 +4,78 @@ import threading
 import cv2
 import numpy as np
 # from PostureModel.posture_main import posture_core
-from FitnessApp.fitnessApp import init_fitness_app
-from FitnessApp.fitnessApp import process_frame_fitness, reset_fitness_app
-from dms.dms_manager import DMSManager
-
-init_fitness_app()
+from FitnessApp.fitnessApp import fitness_app_exit, prewarm_fitness_app
+from FitnessApp.fitnessApp import process_frame_fitness, reset_fitness_app, get_fitness_app
+from dms.model_registry import DMSModelRegistry
+from dms.model_placement import ModelPlacement
+from dms.inference_timer import InferenceTimeLogger
+from frame_pipeline import FramePipeline, PipelineFrame, LatencyTracker
+from frame_source import V4L2Source
+from frame_views import FrameViews
+from motion_gate import MotionGate
+from inference_process import InferenceProcess
 
 '''
-Configure dms managers below with correct flags based on system setup
+Configure dms model registry below with correct flags based on system setup.
+CPU and NPU backends are only loaded when first selected. Set a memory budget
+(MB) to evict the inactive backend instead of keeping both resident.
+With a ModelPlacement the NPU backend runs each model on its fastest device,
+profiled on first load and cached in dms/models-A1/placement_profile.json.
 Linux
 --------
-dms_cpu = DMSManager(run_on_hardware=True, use_npu=False)
-dms_npu = DMSManager(run_on_hardware=True, use_npu=True)
+dms_registry = DMSModelRegistry(run_on_hardware=True, memory_budget_mb=None)
 
 MaaXBoard OSM93
 --------
-dms_cpu = DMSManager(run_on_hardware=True, use_npu=False)
-dms_npu = DMSManager(run_on_hardware=True, use_npu=True)
+dms_registry = DMSModelRegistry(run_on_hardware=True, memory_budget_mb=None,
+								placement=ModelPlacement(run_on_hardware=True))
+
+The registry is built by CreateDMSRegistry() so the inference worker process
+can build its own.
 '''
 
-dms_cpu = DMSManager(run_on_hardware=True, use_npu=False)
-dms_npu = DMSManager(run_on_hardware=True, use_npu=True)
+def CreateDMSRegistry():
+	return DMSModelRegistry(run_on_hardware=True, memory_budget_mb=None,
+							placement=ModelPlacement(run_on_hardware=True))
+
+dms_registry = CreateDMSRegistry()
+
+def RunDemo(demo, image, views, enableNPU):
+	''' Returns the demo results followed by whether the motion gate may reuse them.
+
+	DMS results are only reused while no face is seen: eye closure and yawns
+	barely change the frame, and every processed frame adds to the penalty.
+	'''
+	if demo == 1:
+		#DMS demo app
+		# held so a prewarm of the other backend cannot evict it mid frame
+		with dms_registry.use(enableNPU) as dms:
+			return dms.process_frame_dms(image, views) + (dms.frames_without_face > 0,)
+	#Fitness app demo
+	return process_frame_fitness(image, views) + (True,)
+
+def InferenceWorkerSnapshot():
+	''' Stats the inference worker pushes to the parent, so polling them does not wait for a frame. '''
+	return {"dms": dms_registry.stats(), "models": InferenceTimeLogger().stats()}
+
+def InferenceWorkerHandler(command, image, *args):
+	''' Commands the inference worker process serves, image is the worker's copy of the frame. '''
+	if command == "frame":
+		demo, enableNPU = args
+		return RunDemo(demo, image, FrameViews(image), enableNPU)
+	if command == "reset_fitness":
+		return reset_fitness_app()
+	if command == "exit_fitness":
+		# closes a keypoint recording before the worker exits
+		return fitness_app_exit()
+	# the worker loads in the foreground, frames queued behind wait for the models
+	if command == "prewarm":
+		dms_registry.get(args[0])
+		return None
+	if command == "prewarm_fitness":
+		get_fitness_app()
+		return None
+	raise ValueError("unknown inference worker command " + command)
 
 class cameraSupport():
 	''' Class for managing camera functionality and callbacks with frame data.
@@ -36,129 +87,243 @@ class cameraSupport():
 		callback (callable): A function to be called when a new frame is captured.
 			Defaults to None.
 
+		source (FrameSource): Where frames are read from. Defaults to the V4L2
+			camera at 640x480, 30 fps.
+
+		latency (LatencyTracker): Capture-to-consumer latency and frame budget
+			shared with the frame consumers. Defaults to one without a budget.
+
+		motionGate (MotionGate): Reuses the last demo result while the scene is
+			static, for the fitness demo and for DMS frames without a face.
+			Defaults to MotionGate(threshold=2.0, maxAge=0.5);
+			MotionGate(threshold=None) disables it.
+
+		inferenceProcess (bool): Run the demo models in a separate worker
+			process, frames being exchanged through shared memory, so they do
+			not hold the GIL of the UI and web server. Defaults to False.
+
 	Attributes:
 		runningDemo (int): Flag to set which demo to run, DMS or fitness application.
-		callback (callable): Callback function when new frame captured.
+		callback (callable): Callback function when new frame captured, called
+			with the frame's capture time as the captureTime keyword.
 		onHardware (bool): Indicating whether to run on SBC or linux desktop env.
 		CameraOpen (bool): Indicates whether camera is open or not.
 		running (bool): Indicates whether frames are being capture or not. 
 			Set as True when initialized.
 		frame (object): Last captured frame from openCV.
-		FrameGetterThread (threading.Thread): Thread for capturing frame data from camera.
+		source (FrameSource): Camera, video file, image sequence or synthetic source.
+		pipeline (FramePipeline): Staged worker threads capturing and processing frames.
+		motionGate (MotionGate): Scene change gate in front of the demo inference.
+		inferenceProcess (InferenceProcess): Worker process running the demos,
+			None when they run in this process.
 		EnableNPU (bool): Indicates whether or not to run DMS demo with models 
 			dispatched to CPU or NPU. 
 	'''
 
-	def __init__(self, run_on_hardware = False, callback = None):
+	def __init__(self, run_on_hardware = False, callback = None, source = None, latency = None, motionGate = None,
+				 inferenceProcess = False):
 		self.runningDemo = 0
 		self.callback = callback
 		self.onHardware = run_on_hardware
+		self.source = source if source is not None else V4L2Source(onHardware=run_on_hardware)
 		self.cameraOpen = False
 		self.running = True
 		self.frame = None
-		self.FrameGetterThread = threading.Thread(target=self.FrameGetter)
-		self.FrameGetterThread.start()
+		self.frameSeq = 0
 		self.enableNPU = False
 		# self.PostureDemo = posture_core(None, False)
+		self.latency = latency if latency is not None else LatencyTracker()
+		self.motionGate = motionGate if motionGate is not None else MotionGate(threshold=2.0, maxAge=0.5)
+		self.inferenceProcess = None
+		if inferenceProcess:
+			# a spawned worker imports this module again and builds its own registry and fitness app
+			self.inferenceProcess = InferenceProcess(InferenceWorkerHandler, snapshot=InferenceWorkerSnapshot)
+			self.inferenceProcess.Start()
+		# the fitness demo is selected at start, SwitchDemo() only prewarms on a change
+		self.PrewarmFitness()
+		self.pipeline = FramePipeline(self.CaptureStage,
+									  self.PreprocessStage,
+									  self.InferenceStage,
+									  self.AnnotateStage,
+									  self.PublishStage,
+									  latency=self.latency)
+		self.pipeline.start()
+
+	def SendToWorker(self, command, *args, loading = False):
+		''' Fire and forget command for the inference worker, called from the GTK and web threads. '''
+		try:
+			self.inferenceProcess.Send(command, *args, loading=loading)
+		except Exception as e:
+			print("Cannot send {} to the inference worker: {}".format(command, e))
 
 	def ResetFitnessApp(self):
-		reset_fitness_app()
+		if self.inferenceProcess is not None:
+			self.SendToWorker("reset_fitness")
+		else:
+			reset_fitness_app()
+		self.motionGate.Reset(0)
 
 	def SwitchDemo(self, demo):
+		# called for every GUI event, only a newly selected demo needs its models;
+		# prewarm first so the worker loads them before the demo's first frame
+		if demo == self.runningDemo:
+			return
+		if demo == 1:
+			self.PrewarmDMS()
+		elif demo == 0:
+			self.PrewarmFitness()
 		self.runningDemo = demo
+		# frames queued for the previous demo would only be processed to be ignored
+		self.pipeline.flush()
 
-	def ToggleDMSAcceleration(self):
-		if self.enableNPU == False:
-			self.enableNPU = True
+	def PrewarmFitness(self):
+		# the pose model is only loaded once the fitness demo is selected
+		if self.inferenceProcess is not None:
+			self.SendToWorker("prewarm_fitness", loading=True)
 		else:
-			self.enableNPU = False
+			prewarm_fitness_app()
+
+	def PrewarmDMS(self, enableNPU = None):
+		if enableNPU is None:
+			enableNPU = self.enableNPU
+		if self.inferenceProcess is not None:
+			self.SendToWorker("prewarm", enableNPU, loading=True)
+		else:
+			dms_registry.prewarm(enableNPU)
+
+	def ToggleDMSAcceleration(self):
+		enableNPU = not self.enableNPU
+		if self.runningDemo == 1:
+			# queued before the first frame on the other backend
+			self.PrewarmDMS(enableNPU)
+		self.enableNPU = enableNPU
+		self.motionGate.Reset(1)
+
+	def GetDMSBackendStats(self):
+		if self.inferenceProcess is not None:
+			return (self.inferenceProcess.Snapshot() or {}).get("dms", {})
+		return dms_registry.stats()
+
+	def GetInferenceStats(self):
+		if self.inferenceProcess is not None:
+			return (self.inferenceProcess.Snapshot() or {}).get("models", {})
+		return InferenceTimeLogger().stats()
+
+	def GetInferenceProcessStats(self):
+		return self.inferenceProcess.stats() if self.inferenceProcess is not None else None
 
 	def close(self):
 		self.running = False
+		self.pipeline.stop()
+		if self.inferenceProcess is not None:
+			try:
+				if self.inferenceProcess.Alive():
+					self.inferenceProcess.Call("exit_fitness")
+			except Exception as e:
+				print("Cannot close the fitness app of the inference worker: {}".format(e))
+			self.inferenceProcess.Stop()
+		else:
+			# closes a keypoint recording and the pose worker process of the mediapipe_process backend
+			fitness_app_exit()
 		# self.PostureDemo.Close(self)
-		self.CloseCVDevice(self)
+		self.CloseCVDevice()
 
 	def OpenCVDevice(self):
-		try:
-			if(self.cap.isOpened() == True):
-				self.CloseCVDevice(self)
-		except:
-			pass
-		
-		try:
-			if self.onHardware == True:
-				os.environ['OPENCV_FFMPEG_CAPTURE_OPTIONS'] = 'hwaccel;qsv|video_codec;h264_qsv|vsync;0'
-
-			self.cap = cv2.VideoCapture(cv2.CAP_V4L2)
-			self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-			self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-			self.cap.set(cv2.CAP_PROP_FPS, 30)
-
-			# camera exposure - auto=3, manual=1
-			self.cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 3)
-
-			self.cameraOpen = True
-		except:
-			self.cameraOpen = False
+		if self.source.IsOpened():
+			self.CloseCVDevice()
+		self.cameraOpen = self.source.Open()
 
 	def CloseCVDevice(self):
-		try:
-			self.cameraOpen = False
-			self.cap.release()
-		except:
-			pass
+		self.cameraOpen = False
+		self.source.Close()
 	def CameraOpen(self):
 		return self.cameraOpen
 
 	def GetFrame(self):
 		return self.frame
 
-	def FrameGetter(self):
-		while self.running:
-			if(self.cameraOpen == False):
-				self.OpenCVDevice()
-				time.sleep(1)
-				continue
-
-			else:
-				try:
-					ret, image = self.cap.read()
-
-					if ret and np.any(image):
-						dim = (320, 240)
-						image = cv2.resize(image, dim, interpolation = cv2.INTER_AREA)
-
-						if self.runningDemo == 1:
-							#DMS demo app
-							if self.enableNPU == False:
-								newFrame, attention_status, yawning_status, eye_status, inference_speed, penalty_score, phone_detected = dms_cpu.process_frame_dms(image)
-								self.frame = newFrame
-								self.callback(self.frame, 1, attention_status, yawning_status, eye_status, inference_speed, penalty_score, phone_detected)
-
-							else:	
-								newFrame, attention_status, yawning_status, eye_status, inference_speed, penalty_score, phone_detected = dms_npu.process_frame_dms(image)
-								self.frame = newFrame
-								self.callback(self.frame, 1, attention_status, yawning_status, eye_status, inference_speed, penalty_score, phone_detected)
-
-						elif self.runningDemo == 0:
-							#Fitness app demo
-							newFrame, rom, _, repCount, name, status = process_frame_fitness(image)
-							self.frame = newFrame
-							self.callback(self.frame, 0, rom, repCount, name, status, 0, 0)
-
-						else:
-							# CAN demo selected, ignore input stream
-							pass
-				except:
-					pass
-
-			#time.sleep(0.1)
-
- 
-
-
-	
-	
-
-
-
+	def GetPipelineStats(self):
+		return self.pipeline.stats()
+
+	def GetLatencyStats(self):
+		return self.latency.stats()
+
+	def GetMotionGateStats(self):
+		return self.motionGate.stats()
+
+	def CaptureStage(self):
+		if(self.cameraOpen == False):
+			self.OpenCVDevice()
+			time.sleep(1)
+			return None
+
+		if self.source.CanSkipDecode():
+			# keep draining the driver queue, decode only when inference can take the frame
+			if not self.source.Grab() or not self.pipeline.WantsFrame():
+				return None
+
+		image, timestamp = self.source.Read()
+		if image is None:
+			return None
+
+		self.frameSeq += 1
+		frame = PipelineFrame(self.frameSeq, image)
+		frame.timestamp = timestamp
+		frame.captureTime = timestamp if self.source.timestamps == "monotonic" else time.monotonic()
+		frame.demo = self.runningDemo
+		return frame
+
+	def PreprocessStage(self, frame):
+		if frame.demo not in (0, 1) or not np.any(frame.image):
+			# CAN demo selected, ignore input stream
+			return None
+
+		dim = (320, 240)
+		if frame.image.shape[1::-1] != dim:
+			frame.image = cv2.resize(frame.image, dim, interpolation = cv2.INTER_AREA)
+		frame.views = FrameViews(frame.image)
+		return frame
+
+	def InferenceStage(self, frame):
+		if frame.demo != self.runningDemo:
+			# demo switched while frame was queued
+			return None
+
+		# static scene, reuse the last result of this demo instead of running the models
+		signature = frame.views.Get("motion", lambda: self.motionGate.Signature(frame.image))
+		frame.results = self.motionGate.Lookup(frame.demo, signature)
+		if frame.results is not None:
+			self.latency.Record("inference", frame.captureTime)
+			return frame
+
+		if self.inferenceProcess is not None:
+			if not self.inferenceProcess.Ready():
+				# drop frames while the worker starts up and loads its models
+				self.inferenceProcess.EnsureRunning()
+				return None
+			results = self.inferenceProcess.Call("frame", frame.image, frame.demo, self.enableNPU)
+		else:
+			results = RunDemo(frame.demo, frame.image, frame.views, self.enableNPU)
+		frame.results, reusable = results[:-1], results[-1]
+		if reusable:
+			self.motionGate.Store(frame.demo, signature, frame.results)
+		else:
+			self.motionGate.Reset(frame.demo)
+		self.latency.Record("inference", frame.captureTime)
+		return frame
+
+	def AnnotateStage(self, frame):
+		if frame.demo == 1:
+			newFrame, attention_status, yawning_status, eye_status, inference_speed, penalty_score, phone_detected, _ = frame.results
+			frame.callbackArgs = (newFrame, 1, attention_status, yawning_status, eye_status, inference_speed, penalty_score, phone_detected)
+		else:
+			newFrame, rom, _, repCount, name, status = frame.results
+			frame.callbackArgs = (newFrame, 0, rom, repCount, name, status, 0, 0)
+		frame.image = newFrame
+		return frame
+
+	def PublishStage(self, frame):
+		self.frame = frame.image
+		if self.callback is not None:
+			self.callback(*frame.callbackArgs, captureTime=frame.captureTime)
+		return frame
@@ -0,0 +1,54 @@
+import threading
+
+
+class CascadeRule:
+    """A gating rule that lets the DMS model cascade skip a stage"""
+
+    def __init__(self, stage, name, condition):
+        """
+        Creates a rule
+
+        Arguments:
+        stage -- the stage the rule gates, e.g. "eyes" or "yolo"
+        name -- the rule name used in the skip counters
+        condition -- callable receiving the stage context as keywords, True to skip
+        """
+        self.stage = stage
+        self.name = name
+        self.condition = condition
+        self.skips = 0
+
+
+class ModelCascade:
+    """
+    Declarative gating of the DMS model stages.
+
+    Before running a stage the manager asks skip(stage, **context). The first
+    rule of that stage whose condition holds skips it and counts the skip, so
+    the work saved by every rule can be read back from stats().
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.checks = {}
+        self.lock = threading.Lock()
+
+    def skip(self, stage, **context):
+        """Return the name of the rule skipping stage, or None to run it"""
+        with self.lock:
+            self.checks[stage] = self.checks.get(stage, 0) + 1
+        for rule in self.rules:
+            if rule.stage == stage and rule.condition(**context):
+                with self.lock:
+                    rule.skips += 1
+                return rule.name
+        return None
+
+    def stats(self):
+        """Checks and skips per rule for every stage"""
+        with self.lock:
+            stats = {stage: {"checked": checks, "skipped": {}} for stage, checks in self.checks.items()}
+            for rule in self.rules:
+                stage = stats.setdefault(rule.stage, {"checked": 0, "skipped": {}})
+                stage["skipped"][rule.name] = rule.skips
+            return stats
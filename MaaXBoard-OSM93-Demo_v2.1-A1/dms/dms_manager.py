@@ -15,7 +15,9 @@ from dms.eye_landmark import EyeMesher
 from dms.face_landmark import FaceMesher
 from dms.utils import *
 from dms.inference_timer import InferenceTimeLogger
-from dms.smoking_calling_yolov4 import SmokingCallingDetector
+from dms.smoking_calling_yolov4 import SmokingCallingDetector, AsyncSmokingCallingDetector
+from dms.cascade import CascadeRule, ModelCascade
+from frame_views import FrameViews
 
 BAD_FACE_PENALTY = 0.01
 """ % to remove for far away face """
@@ -44,11 +46,42 @@ RESTORE_CREDIT = -5.0
 SMK_CALL_THRESHOLD = 0.7
 """ The threshold value for smoking/calling detection """
 
+TRACKING_SCORE_THRESHOLD = 0.5
+""" Face mesh score below which the tracked face is dropped and the detector re-run """
+
+KEYFRAME_INTERVAL = 10
+""" Max frames to track a face from its mesh before forcing a face detection """
+
+SMK_CALL_RATE_HZ = 3.0
+""" Smoking/calling detections per second, None to run on every frame """
+
+SMK_CALL_MAX_AGE = 2.0
+""" Seconds after which a smoking/calling result is too stale to report """
+
+CASCADE_FACE_SCORE_THRESHOLD = 0.5
+""" Face mesh score below which a face is not analysed further (mouth, eyes, gaze) """
+
+CASCADE_MAX_EYE_YAW = 45.0
+""" |yaw| in degrees above which the eye models are skipped and gaze follows the head pose """
+
+CASCADE_NO_FACE_FRAMES = 30
+""" Frames without a face after which smoking/calling detection is skipped """
+
 
 class DMSManager:
-    def __init__(self, run_on_hardware=False, use_npu=False):
+    def __init__(self, run_on_hardware=False, use_npu=False, face_tracking=True,
+                 keyframe_interval=KEYFRAME_INTERVAL, tracking_score_threshold=TRACKING_SCORE_THRESHOLD,
+                 smk_call_rate_hz=SMK_CALL_RATE_HZ, batch_eyes=True, placement=None, cascade=True):
         self.run_on_hardware = run_on_hardware
         self.use_npu = use_npu
+        self.placement = placement
+        self.face_tracking = face_tracking
+        self.keyframe_interval = keyframe_interval
+        self.tracking_score_threshold = tracking_score_threshold
+        self.tracked_face = None
+        self.keyframe_faces = []
+        self.frames_since_detection = 0
+        self.frames_without_face = 0
         self.path_to_models = model_paths.MODEL_DIR
         self.face_detector = None
         self.face_mesher = None
@@ -60,28 +93,82 @@ class DMSManager:
         self.inference_speed = None
         self.face_in_frame = False
         self.safe_value = 0
-        self.phone_detected = True
-        self.inference_logger = InferenceTimeLogger()
+        self.phone_detected = False
+        self.phone_detected_age = None
         self.platform = "i.MX93"
 
-        model_selector = model_paths.NPU_MODELS if self.use_npu else model_paths.CPU_MODELS
-        DELEGATE_PATH = "/usr/lib/libethosu_delegate.so" if self.use_npu else None
+        # device per model, either all on the selected one or as profiled by the placement
+        if self.placement is not None:
+            self.model_plan = dict(self.placement.load())
+        else:
+            device = "NPU" if self.use_npu else "CPU"
+            self.model_plan = {key: device for key in model_paths.MODELS[device]}
 
-        self.face_detector = FaceDetector(model_path = str(self.path_to_models + model_selector['DETECT_MODEL']), 
-                                          delegate_path = DELEGATE_PATH, 
+        detect_model, detect_delegate = self.model_file('DETECT_MODEL')
+        self.face_detector = FaceDetector(model_path = detect_model, 
+                                          delegate_path = detect_delegate, 
                                           img_size=self.target_dim,
                                           run_on_hardware=self.run_on_hardware)
         
-        self.face_mesher = FaceMesher(model_path=str((self.path_to_models + model_selector['LANDMARK_MODEL'])), 
-                                      delegate_path = DELEGATE_PATH,
+        landmark_model, landmark_delegate = self.model_file('LANDMARK_MODEL')
+        self.face_mesher = FaceMesher(model_path=landmark_model, 
+                                      delegate_path = landmark_delegate,
                                       run_on_hardware=self.run_on_hardware)
         
-        self.eye_mesher = EyeMesher(model_path=str((self.path_to_models + model_selector['EYE_MODEL'])),
-                                    delegate_path = DELEGATE_PATH,
-                                    run_on_hardware=self.run_on_hardware)
-
-        inf_device = "NPU"
-        self.smoking_calling_detector = SmokingCallingDetector(str((self.path_to_models + model_selector['YOLO_MODEL'])), inf_device, self.platform, conf=SMK_CALL_THRESHOLD)
+        eye_model, eye_delegate = self.model_file('EYE_MODEL')
+        self.eye_mesher = EyeMesher(model_path=eye_model,
+                                    delegate_path = eye_delegate,
+                                    run_on_hardware=self.run_on_hardware,
+                                    batched=batch_eyes)
+
+        yolo_model, _ = self.model_file('YOLO_MODEL')
+        self.smoking_calling_detector = SmokingCallingDetector(yolo_model, self.model_plan['YOLO_MODEL'], self.platform, conf=SMK_CALL_THRESHOLD)
+
+        # per frame time spent in the face models of this backend, YOLO runs on its own thread
+        self.model_timers = [self.face_detector.inference_timer, self.face_mesher.inference_timer, self.eye_mesher.inference_timer]
+        self.frame_timer = InferenceTimeLogger().histogram("dms_frame", "NPU" if self.use_npu else "CPU")
+
+        # stages are skipped when their result could not change a decision
+        rules = []
+        if cascade:
+            rules = [
+                CascadeRule("yolo", "no_face", lambda frames_without_face: frames_without_face >= CASCADE_NO_FACE_FRAMES),
+                CascadeRule("face", "low_mesh_score", lambda mesh_score: mesh_score < CASCADE_FACE_SCORE_THRESHOLD),
+                CascadeRule("eyes", "extreme_yaw", lambda yaw: abs(yaw) > CASCADE_MAX_EYE_YAW),
+            ]
+        self.cascade = ModelCascade(rules)
+
+        # YOLO only drives a slow changing flag, so run it off the frame path
+        self.async_smoking_calling_detector = None
+        if smk_call_rate_hz:
+            self.async_smoking_calling_detector = AsyncSmokingCallingDetector(self.smoking_calling_detector, smk_call_rate_hz)
+
+    def model_file(self, key):
+        device = self.model_plan[key]
+        return str(self.path_to_models + model_paths.MODELS[device][key]), model_paths.DELEGATES[device]
+
+    def models_time(self):
+        return sum(timer.total for timer in self.model_timers)
+
+    def close(self):
+        if self.async_smoking_calling_detector is not None:
+            self.async_smoking_calling_detector.close()
+
+    def update_phone_detected(self, image, views=None):
+        if self.async_smoking_calling_detector is None:
+            call_result = self.smoking_calling_detector.inference(image, False, views)
+            self.phone_detected = len(call_result) > 0
+            self.phone_detected_age = 0.0
+            return
+
+        self.async_smoking_calling_detector.submit(image, views)
+        call_result, result_time = self.async_smoking_calling_detector.latest()
+        if result_time is None:
+            return
+
+        # fuse the latest result, dropping it once it is too old to trust
+        self.phone_detected_age = time.monotonic() - result_time
+        self.phone_detected = len(call_result) > 0 and self.phone_detected_age <= SMK_CALL_MAX_AGE
 
     def draw_face_box(self, image, bboxes, landmarks, scores):
         for bbox, landmark, score in zip(bboxes.astype(int), landmarks.astype(int), scores):
@@ -102,7 +189,13 @@ class DMSManager:
         return image
 
     # detect single frame
-    def process_frame_dms(self, image):
+    def process_frame_dms(self, image, views=None):
+        """
+        views -- FrameViews of image shared with other consumers, created if not given
+
+        The status ends with phone_detected and phone_detected_age, the age in
+        seconds of the smoking/calling result it is based on (None without one).
+        """
         # distraction variables for penalty
         attention = False
         yawn = False
@@ -111,38 +204,39 @@ class DMSManager:
 
         h, w, _ = image.shape
         # print("DMS image shape", image.shape)
+        models_time = self.models_time()
 
-        target_dim = max(w, h)
-        padded_size = [(target_dim - h) // 2, (target_dim - h + 1) // 2,
-                    (target_dim - w) // 2, (target_dim - w + 1) // 2]
-        padded = cv2.copyMakeBorder(image.copy(),
-                                    *padded_size,
-                                    cv2.BORDER_CONSTANT,
-                                    value=[0, 0, 0])
-        padded = cv2.flip(padded, 3)
+        if views is None:
+            views = FrameViews(image)
+        padded, padded_size = views.Padded()
 
         try:
             #print("run call model")
-            call_result = self.smoking_calling_detector.inference(image, False)
-            if len(call_result != 0):
-                self.phone_detected = True
-            else:
+            if self.cascade.skip("yolo", frames_without_face=self.frames_without_face):
+                # nobody in the seat, nothing to smoke or call
                 self.phone_detected = False
-
-
-            #print("call result: ", call_result)
-
+                self.phone_detected_age = None
+            else:
+                self.update_phone_detected(image, views)
         except:
             print("error")
         
-        # face detection
-        bboxes_decoded, landmarks, scores = self.face_detector.inference(padded)
-
-        self.inference_logger.calculate_total_model_averages()
-        model_avgs = self.inference_logger.get_models_inf_average()
-        self.inference_speed = "{:.2f}".format(model_avgs*1000)
+        # face detection, skipped between keyframes while the face is tracked from its mesh
+        keyframe = self.tracked_face is None or self.frames_since_detection >= self.keyframe_interval
+        if keyframe:
+            detect_size = tuple(self.face_detector.input_shape[::-1])
+            bboxes_decoded, landmarks, scores = self.face_detector.inference(padded, views.Resized(detect_size, padded=True))
+            self.frames_since_detection = 0
+        else:
+            bboxes_decoded, landmarks, scores = self.tracked_face
+            self.frames_since_detection += 1
+        self.frames_without_face = 0 if len(bboxes_decoded) else self.frames_without_face + 1
+        self.tracked_face = None
+        tracked_bboxes, tracked_landmarks, tracked_scores = [], [], []
+        keyframe_faces = []
 
         mesh_landmarks_inverse = []
+        mesh_scores_list = []
         r_vecs, t_vecs = [], []
 
         for i, (bbox, landmark) in enumerate(zip(bboxes_decoded, landmarks)):
@@ -151,39 +245,71 @@ class DMSManager:
             mesh_landmark, mesh_scores = self.face_mesher.inference(aligned_face)
             mesh_landmark_inverse = self.face_detector.inverse(mesh_landmark, M)
             mesh_landmarks_inverse.append(mesh_landmark_inverse)
+            mesh_scores_list.append(mesh_scores)
+
+            # next frame's alignment ROI comes from this mesh while it stays confident
+            if self.face_tracking and mesh_scores >= self.tracking_score_threshold:
+                if keyframe:
+                    key_face = (bbox, landmark, mesh_landmark_inverse)
+                    tracked_bbox, tracked_landmark = bbox, landmark
+                else:
+                    key_face = self.keyframe_faces[i]
+                    tracked_bbox, tracked_landmark = track_detection(*key_face, mesh_landmark_inverse)
+
+                if tracked_bbox is not None:
+                    keyframe_faces.append(key_face)
+                    tracked_bboxes.append(tracked_bbox)
+                    tracked_landmarks.append(tracked_landmark)
+                    tracked_scores.append(mesh_scores)
 
             # pose detection
             r_vec, t_vec = self.face_detector.decode_pose(landmark)
             r_vecs.append(r_vec)
             t_vecs.append(t_vec)
 
+        self.keyframe_faces = keyframe_faces
+        if tracked_bboxes:
+            self.tracked_face = (np.array(tracked_bboxes), np.array(tracked_landmarks), np.array(tracked_scores))
+
         # draw
-        image_show = padded.copy()
-        self.draw_face_box(image_show, bboxes_decoded, landmarks, scores)
-        for i, (mesh_landmark, r_vec, t_vec) in enumerate(zip(mesh_landmarks_inverse, r_vecs, t_vecs)):
+        # annotate the original frame, mapping detections out of the padded mirrored view
+        image_show = image.copy()
+        corners = views.PaddedToImage(bboxes_decoded.reshape(-1, 2, 2))
+        display_bboxes = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+        display_landmarks = views.PaddedToImage(landmarks.reshape(-1, 2)).reshape(landmarks.shape)
+        self.draw_face_box(image_show, display_bboxes, display_landmarks, scores)
+        for i, (mesh_landmark, mesh_score, r_vec, t_vec) in enumerate(zip(mesh_landmarks_inverse, mesh_scores_list, r_vecs, t_vecs)):
+            # not a valid face, its mouth, eyes and gaze would be noise
+            if self.cascade.skip("face", mesh_score=mesh_score):
+                continue
+
             mouth_ratio = get_mouth_ratio(mesh_landmark, image_show)
-            left_box, right_box = get_eye_boxes(mesh_landmark, padded.shape)
+            pitch, roll, yaw = get_face_angle(r_vec, t_vec)
 
-            left_eye_img = padded[left_box[0][1]:left_box[1][1], left_box[0][0]:left_box[1][0]]
-            right_eye_img = padded[right_box[0][1]:right_box[1][1], right_box[0][0]:right_box[1][0]]
+            # eye openness and iris ratios are meaningless when the head is turned too far
+            skip_eyes = self.cascade.skip("eyes", yaw=yaw)
+            if not skip_eyes:
+                left_box, right_box = get_eye_boxes(mesh_landmark, padded.shape)
 
-            if np.any(left_eye_img) == False or np.any(right_eye_img) == False:
-                break
+                left_eye_img = padded[left_box[0][1]:left_box[1][1], left_box[0][0]:left_box[1][0]]
+                right_eye_img = padded[right_box[0][1]:right_box[1][1], right_box[0][0]:right_box[1][0]]
 
-            left_eye_landmarks, left_iris_landmarks = self.eye_mesher.inference(left_eye_img)
-            right_eye_landmarks, right_iris_landmarks = self.eye_mesher.inference(right_eye_img)
-            
+                if np.any(left_eye_img) == False or np.any(right_eye_img) == False:
+                    break
 
-            # Adds boxes around the eyes
-            # cv2.rectangle(image_show, left_box[0], left_box[1], color=(255, 0, 0), thickness=2)
-            # cv2.rectangle(image_show, right_box[0], right_box[1], color=(255, 0, 0), thickness=2)
-            
-            
-            left_eye_ratio = get_eye_ratio(left_eye_landmarks, image_show, left_box[0])
-            right_eye_ratio = get_eye_ratio(right_eye_landmarks, image_show, right_box[0])
+                (left_eye_landmarks, left_iris_landmarks,
+                 right_eye_landmarks, right_iris_landmarks) = self.eye_mesher.inference_pair(left_eye_img, right_eye_img)
+                
 
-            pitch, roll, yaw = get_face_angle(r_vec, t_vec)
-            iris_ratio = get_iris_ratio(left_iris_landmarks, right_iris_landmarks)
+                # Adds boxes around the eyes
+                # cv2.rectangle(image_show, left_box[0], left_box[1], color=(255, 0, 0), thickness=2)
+                # cv2.rectangle(image_show, right_box[0], right_box[1], color=(255, 0, 0), thickness=2)
+                
+                
+                left_eye_ratio = get_eye_ratio(left_eye_landmarks, image_show, left_box[0])
+                right_eye_ratio = get_eye_ratio(right_eye_landmarks, image_show, right_box[0])
+
+                iris_ratio = get_iris_ratio(left_iris_landmarks, right_iris_landmarks)
 
             if mouth_ratio > 0.2:
                 self.yawning_status = True
@@ -192,18 +318,21 @@ class DMSManager:
                 self.yawning_status = False
                 yawn = False    
 
-            if left_eye_ratio < 0.25 and right_eye_ratio < 0.25:
+            # with the eyes skipped the eye status is kept from the last frame they were seen
+            if skip_eyes:
+                sleep = False
+            elif left_eye_ratio < 0.25 and right_eye_ratio < 0.25:
                 self.eye_status = True
                 sleep = True
             else:
                 self.eye_status = False
                 sleep = False
 
-            if yaw > 15 and iris_ratio > 1.15:
+            if yaw > 15 and (skip_eyes or iris_ratio > 1.15):
                 self.attention_status = "Left"
                 attention = False
 
-            elif yaw < -15 and iris_ratio < 0.85:
+            elif yaw < -15 and (skip_eyes or iris_ratio < 0.85):
                 self.attention_status = "Right"
                 attention = False
 
@@ -231,8 +360,8 @@ class DMSManager:
             # print("credit store")
             self.safe_value = max(self.safe_value + RESTORE_CREDIT, 0.00)
 
-        # remove pad
-        image_show = image_show[padded_size[0]:target_dim - padded_size[1], padded_size[2]:target_dim - padded_size[3]]
-        image_show = cv2.flip(image_show, 1)
-        return image_show, self.attention_status, self.yawning_status, self.eye_status, self.inference_speed, self.safe_value, self.phone_detected
+        self.frame_timer.record((self.models_time() - models_time) / 1000)
+        self.inference_speed = "{:.2f}".format(self.frame_timer.percentile(50))
+
+        return image_show, self.attention_status, self.yawning_status, self.eye_status, self.inference_speed, self.safe_value, self.phone_detected, self.phone_detected_age
 
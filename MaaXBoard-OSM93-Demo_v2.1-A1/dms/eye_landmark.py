@@ -7,74 +7,111 @@
 import math
 import cv2
 import numpy as np
-import time
-from dms.inference_timer import InferenceTimeLogger
+from concurrent.futures import ThreadPoolExecutor
+from dms.model_runner import ModelRunner
+from dms.utils import make_input_lut, fill_input_tensor
 
 
 
 class EyeMesher:
     EYE_KEY_NUM = 71
     IRIS_KEY_NUM = 5
-
-    def __init__(self, model_path, delegate_path, run_on_hardware=False):
-
-        self.inference_logger = InferenceTimeLogger()
-    
-        if run_on_hardware:
-            import tflite_runtime.interpreter as tflite
-        else:
-            import tensorflow.lite as tflite
-        
-        if(delegate_path):
-            ext_delegate = [tflite.load_delegate(delegate_path)]
-            self.interpreter = tflite.Interpreter(model_path=model_path, experimental_delegates=ext_delegate)
-        else:
-            self.interpreter = tflite.Interpreter(model_path=model_path)
-
-        self.interpreter.allocate_tensors()
-        self.input_idx = self.interpreter.get_input_details()[0]['index']
-        self.input_shape = self.interpreter.get_input_details()[0]['shape'][1:3]
-
-        outputs_idx_tmp = {}
-        for output in self.interpreter.get_output_details():
-            outputs_idx_tmp[output['name']] = output['index']
-        self.outputs_idx = {'eye': outputs_idx_tmp['output_eyes_contours_and_brows:0'],
-                'iris': outputs_idx_tmp['output_iris:0']}
-
-    def inference(self, image):
+    EYE_SLOTS = 2
+
+    def __init__(self, model_path, delegate_path, run_on_hardware=False, batched=False, timer_name=None):
+
+        self.runner = ModelRunner("iris_landmark", model_path, delegate_path, run_on_hardware, timer_name=timer_name)
+        self.inference_timer = self.runner.timer
+
+        self.input_shape = self.runner.input_shape
+        # integer models are fed directly, x / 255 folded into the lut
+        self.input_lut = make_input_lut(self.runner.input_details[0], 1 / 255.0, 0.0)
+
+        # both eyes in one invoke when the interpreter accepts a batch of 2,
+        # otherwise a second interpreter runs the other eye on its own thread,
+        # timed apart so the parallel invokes are not counted twice as iris_landmark
+        self.batch_size = 1
+        self.partner = None
+        self.executor = None
+        if batched and not self.resize_batch(self.EYE_SLOTS):
+            self.partner = EyeMesher(model_path, delegate_path, run_on_hardware, batched=False,
+                                     timer_name="iris_landmark_partner")
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.outputs_names = {'eye': 'output_eyes_contours_and_brows:0', 'iris': 'output_iris:0'}
+
+        # preprocessing writes straight into the interpreter's input buffer and
+        # outputs are postprocessed into preallocated arrays, one slot per eye
+        self.input_tensor = self.runner.input_views[0]
+        self.resized = np.empty((*self.input_shape, 3), dtype=np.uint8)
+        self.eye_landmarks = np.empty((self.EYE_SLOTS, self.EYE_KEY_NUM, 3), dtype=np.float32)
+        self.iris_landmarks = np.empty((self.EYE_SLOTS, self.IRIS_KEY_NUM, 3), dtype=np.float32)
+        self.landmark_scale = np.ones(3, dtype=np.float32)
+
+    def resize_batch(self, batch_size):
+        """Try to resize the input to batch_size, returns False if the model/delegate cannot batch"""
+        single_sizes = [np.prod(output['shape']) for output in self.runner.output_details]
+        # fixed shape models (e.g. Vela compiled) fail here and start over with a fresh interpreter
+        if not self.runner.resize_input([batch_size, *self.input_shape, 3]):
+            return False
+        # outputs are flattened to [1, -1] by the model, batches end up back to back
+        for output, single_size in zip(self.runner.output_details, single_sizes):
+            if np.prod(output['shape']) != batch_size * single_size:
+                self.runner.load()
+                return False
+        self.batch_size = batch_size
+        return True
+
+    def invoke(self):
+        self.runner.invoke()
+
+    def postprocess(self, image, batch, slot):
         h, w = self.input_shape
+        eye_landmarks = self.runner.output(self.outputs_names['eye']).reshape(self.batch_size, -1)
+        iris_landmarks = self.runner.output(self.outputs_names['iris']).reshape(self.batch_size, -1)
+
+        self.landmark_scale[0] = image.shape[1] / w
+        self.landmark_scale[1] = image.shape[0] / h
+        eye_landmarks = np.multiply(eye_landmarks[batch].reshape(self.EYE_KEY_NUM, 3), self.landmark_scale,
+                                    out=self.eye_landmarks[slot])
+        iris_landmarks = np.multiply(iris_landmarks[batch].reshape(self.IRIS_KEY_NUM, 3), self.landmark_scale,
+                                     out=self.iris_landmarks[slot])
+        return eye_landmarks, iris_landmarks
 
-        image_ = cv2.resize(image, tuple(self.input_shape)).astype(np.float32)
-        image_ = (image_) / 255.0
-        if len(image_.shape) < 4:
-            image_ = image_[None, ...]
+    def inference(self, image, slot=0):
+        """Returned landmarks are reused by the next call with the same slot"""
+        cv2.resize(image, tuple(self.input_shape), dst=self.resized)
+        for batch in range(self.batch_size):
+            fill_input_tensor(self.input_tensor, self.resized, self.input_lut, 1 / 255.0, 0.0, batch)
 
         # invoke
-        self.interpreter.set_tensor(self.input_idx, image_)
-        start = time.time()
-        self.interpreter.invoke()
-        end = time.time()
-        delta = end-start
-        self.inference_logger.iris_inf_time = delta
-        # print("IRIS inference time:", delta)
-
-        eye_landmarks = self.interpreter.get_tensor(self.outputs_idx['eye'])
-        iris_landmarks = self.interpreter.get_tensor(self.outputs_idx['iris'])
+        self.invoke()
 
         # postprocessing
-        eye_landmarks = eye_landmarks.reshape(self.EYE_KEY_NUM, 3)
-        eye_landmarks[:, 0] /= w
-        eye_landmarks[:, 1] /= h
-        eye_landmarks[:, 0] *= image.shape[1]
-        eye_landmarks[:, 1] *= image.shape[0]
-
-        iris_landmarks = iris_landmarks.reshape(self.IRIS_KEY_NUM, 3)
-        iris_landmarks[:, 0] /= w
-        iris_landmarks[:, 1] /= h
-        iris_landmarks[:, 0] *= image.shape[1]
-        iris_landmarks[:, 1] *= image.shape[0]
+        eye_landmarks, iris_landmarks = self.postprocess(image, 0, slot)
 
         # print("eye landmarks/iris", eye_landmarks, iris_landmarks)
         return eye_landmarks, iris_landmarks
 
+    def inference_pair(self, left_image, right_image):
+        """Run both eyes in one pass, returns left eye, left iris, right eye, right iris landmarks"""
+        if self.partner is not None:
+            right = self.executor.submit(self.partner.inference, right_image, 1)
+            left_eye, left_iris = self.inference(left_image, 0)
+            right_eye, right_iris = right.result()
+            return left_eye, left_iris, right_eye, right_iris
+
+        if self.batch_size < 2:
+            left_eye, left_iris = self.inference(left_image, 0)
+            right_eye, right_iris = self.inference(right_image, 1)
+            return left_eye, left_iris, right_eye, right_iris
+
+        for batch, image in enumerate((left_image, right_image)):
+            cv2.resize(image, tuple(self.input_shape), dst=self.resized)
+            fill_input_tensor(self.input_tensor, self.resized, self.input_lut, 1 / 255.0, 0.0, batch)
+
+        self.invoke()
 
+        left_eye, left_iris = self.postprocess(left_image, 0, 0)
+        right_eye, right_iris = self.postprocess(right_image, 1, 1)
+        return left_eye, left_iris, right_eye, right_iris
@@ -7,9 +7,8 @@
 import math
 import cv2
 import numpy as np
-import time
-from dms.utils import nms_oneclass
-from dms.inference_timer import InferenceTimeLogger
+from dms.utils import nms_oneclass, make_input_lut, fill_input_tensor
+from dms.model_runner import ModelRunner
 
 FACE_MODEL_3D = np.array([
     (-165.0, 170.0, -135.0),  # left eye
@@ -33,27 +32,17 @@ class FaceDetector:
                  run_on_hardware = False
                  ):
 
-    
-        self.inference_logger = InferenceTimeLogger()
-        
-        if run_on_hardware:
-            import tflite_runtime.interpreter as tflite
-        else:
-            import tensorflow.lite as tflite
-
-        if(delegate_path):
-            ext_delegate = [tflite.load_delegate(delegate_path)]
-            self.interpreter = tflite.Interpreter(model_path=model_path, experimental_delegates=ext_delegate)
-        else:
-            self.interpreter = tflite.Interpreter(model_path=model_path)
 
-        self.interpreter.allocate_tensors()
-        self.input_idx = self.interpreter.get_input_details()[0]['index']
-        self.input_shape = self.interpreter.get_input_details()[0]['shape'][1:3]
+        self.runner = ModelRunner("face_detection", model_path, delegate_path, run_on_hardware)
+        self.inference_timer = self.runner.timer
 
-        self.outputs_idx = {}
-        for output in self.interpreter.get_output_details():
-            self.outputs_idx[output['name']] = output['index']
+        self.input_shape = self.runner.input_shape
+        # integer models are fed directly, (x - 128) / 128 folded into the lut
+        self.input_lut = make_input_lut(self.runner.input_details[0], 1 / 128.0, -1.0)
+        # preprocessing writes straight into the interpreter's input buffer
+        self.input_tensor = self.runner.input_views[0]
+        self.resized = np.empty((*self.input_shape, 3), dtype=np.uint8)
+        self.scores = np.empty(np.prod(self.runner.outputs['classificators']['shape']), dtype=np.float32)
 
         self.anchors = self.create_anchors(self.input_shape)
 
@@ -75,23 +64,21 @@ class FaceDetector:
         # Assuming no lens distortion
         self.dist_coeffs = np.zeros((4, 1))
 
-    def inference(self, img):
-        # convert to float32
-        input_data = cv2.resize(img, tuple(self.input_shape)).astype(np.float32)
-        input_data = (input_data - 128.0) / 128.0
-        input_data = np.expand_dims(input_data, axis=0)
+    def inference(self, img, resized=None):
+        """resized -- img already resized to the model input, e.g. from FrameViews"""
+        if resized is None:
+            resized = cv2.resize(img, tuple(self.input_shape), dst=self.resized)
+        fill_input_tensor(self.input_tensor, resized, self.input_lut, 1 / 128.0, -1.0)
 
         # invoke
-        self.interpreter.set_tensor(self.input_idx, input_data)
-        start = time.time()
-        self.interpreter.invoke()
-        end = time.time()
-        delta = end-start
-        self.inference_logger.face_detection_inf_time = delta
-        # print("Face detection inference time:", delta)
-        scores = self.interpreter.get_tensor(self.outputs_idx['classificators']).squeeze()
-        scores = 1 / (1 + np.exp(-scores))
-        bboxes = self.interpreter.get_tensor(self.outputs_idx['regressors']).squeeze()
+        self.runner.invoke()
+        # outputs are read through views, sigmoid is applied in place
+        scores = self.runner.output('classificators')
+        scores = np.negative(scores.reshape(-1), out=self.scores)
+        np.exp(scores, out=scores)
+        scores += 1
+        np.reciprocal(scores, out=scores)
+        bboxes = self.runner.output('regressors').squeeze()
 
         bboxes_decoded, landmarks, scores = self.decode(scores, bboxes)
         bboxes_decoded *= img.shape[0]
@@ -7,8 +7,8 @@
 import math
 import cv2
 import numpy as np
-import time
-from dms.inference_timer import InferenceTimeLogger
+from dms.model_runner import ModelRunner
+from dms.utils import make_input_lut, fill_input_tensor
 
 
 class FaceMesher:
@@ -16,52 +16,36 @@ class FaceMesher:
 
     def __init__(self, model_path, delegate_path, run_on_hardware=False):
 
-        self.inference_logger = InferenceTimeLogger()
+        self.runner = ModelRunner("face_landmark", model_path, delegate_path, run_on_hardware)
+        self.inference_timer = self.runner.timer
 
-        if run_on_hardware:
-            import tflite_runtime.interpreter as tflite
-        else:
-            import tensorflow.lite as tflite
+        self.input_shape = self.runner.input_shape
+        # integer models are fed directly, (x - 128) / 128 folded into the lut
+        self.input_lut = make_input_lut(self.runner.input_details[0], 1 / 128.0, -1.0)
+        self.outputs_names = {'landmark': 'conv2d_20', 'score': 'conv2d_30'}
 
-        if(delegate_path):
-            ext_delegate = [tflite.load_delegate(delegate_path)]
-            self.interpreter = tflite.Interpreter(model_path=model_path, experimental_delegates=ext_delegate)
-        else:
-            self.interpreter = tflite.Interpreter(model_path=model_path)
-
-        self.interpreter.allocate_tensors()
-        self.input_idx = self.interpreter.get_input_details()[0]['index']
-        self.input_shape = self.interpreter.get_input_details()[0]['shape'][1:3]
-
-        outputs_idx_tmp = {}
-        for output in self.interpreter.get_output_details():
-            outputs_idx_tmp[output['name']] = output['index']
-        self.outputs_idx = {'landmark': outputs_idx_tmp['conv2d_20'],
-                            'score': outputs_idx_tmp['conv2d_30']}
+        # preprocessing writes straight into the interpreter's input buffer and
+        # outputs are postprocessed into preallocated arrays
+        self.input_tensor = self.runner.input_views[0]
+        self.resized = np.empty((*self.input_shape, 3), dtype=np.uint8)
+        self.landmarks = np.empty((self.FACE_KEY_NUM, 3), dtype=np.float32)
+        self.landmark_scale = np.ones(3, dtype=np.float32)
 
     def inference(self, img):
+        """Returned landmarks are reused by the next call, copy them to keep them"""
         h, w = self.input_shape
-        input_data = cv2.resize(img, tuple(self.input_shape)).astype(np.float32)
-        input_data = (input_data - 128.0) / 128.0
-        input_data = np.expand_dims(input_data, axis=0)
+        cv2.resize(img, tuple(self.input_shape), dst=self.resized)
+        fill_input_tensor(self.input_tensor, self.resized, self.input_lut, 1 / 128.0, -1.0)
 
         # invoke
-        self.interpreter.set_tensor(self.input_idx, input_data)
-        start = time.time()
-        self.interpreter.invoke()
-        end = time.time()
-        delta = end-start
-        self.inference_logger.face_landmark_inf_time = delta
-        # print("face landmark inference time:", delta)
-        landmarks = self.interpreter.get_tensor(self.outputs_idx['landmark'])
-        scores = self.interpreter.get_tensor(self.outputs_idx['score'])
+        self.runner.invoke()
+        landmarks = self.runner.output(self.outputs_names['landmark'])
+        scores = self.runner.output(self.outputs_names['score'])
 
         # postprocessing
-        landmarks = landmarks.reshape(self.FACE_KEY_NUM, 3)
-        landmarks[:, 0] /= w
-        landmarks[:, 1] /= h
-        landmarks[:, 0] *= img.shape[1]
-        landmarks[:, 1] *= img.shape[0]
+        self.landmark_scale[0] = img.shape[1] / w
+        self.landmark_scale[1] = img.shape[0] / h
+        landmarks = np.multiply(landmarks.reshape(self.FACE_KEY_NUM, 3), self.landmark_scale, out=self.landmarks)
         score = 1.0 / (1.0 + math.exp(-scores.ravel()[0]))
 
         # print("face landmark/scores", landmarks, scores)
@@ -1,28 +1,106 @@
-import time
+import threading
+import numpy as np
+
+HISTORY_SIZE = 256
+""" Latest samples kept per model and backend for the percentiles """
+
+
+class LatencyHistogram:
+    """
+    Fixed size ring buffer of latencies (ms) for one model on one backend.
+
+    Percentiles are computed over the last HISTORY_SIZE samples, while count,
+    min, max and total cover every sample since start.
+    """
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.samples = np.zeros(size, dtype=np.float64)
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            self.samples[self.index] = ms
+            self.index = (self.index + 1) % len(self.samples)
+            self.count += 1
+            self.total += ms
+            self.last = ms
+            self.min = ms if self.min is None else min(self.min, ms)
+            self.max = ms if self.max is None else max(self.max, ms)
+
+    def window(self):
+        with self.lock:
+            return self.samples[:min(self.count, len(self.samples))].copy()
+
+    def percentile(self, q):
+        window = self.window()
+        return float(np.percentile(window, q)) if len(window) else 0.0
+
+    def stats(self):
+        window = self.window()
+        if not len(window):
+            return {"count": 0}
+        p50, p95, p99 = np.percentile(window, (50, 95, 99))
+        return {
+            "count": self.count,
+            "p50": round(float(p50), 2),
+            "p95": round(float(p95), 2),
+            "p99": round(float(p99), 2),
+            "min": round(self.min, 2),
+            "max": round(self.max, 2),
+            "last": round(self.last, 2),
+        }
+
 
 class InferenceTimeLogger:
+    """
+    Process wide registry of latency histograms keyed by (model, backend).
+
+    Every model wrapper records its invoke time under its own model name and the
+    device it runs on, so CPU and NPU samples are never mixed.
+    """
 
     _instance = None
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(InferenceTimeLogger, cls).__new__(cls)
+            cls._instance.histograms = {}
+            cls._instance.lock = threading.Lock()
         return cls._instance
 
-    def __init__(self):
-        self.sample_size = 10
-        self.inference_averages = []
-        self.face_detection_inf_time = 0
-        self.face_landmark_inf_time = 0
-        self.iris_inf_time = 0
-
-    def calculate_total_model_averages(self):
-        average = ((self.face_detection_inf_time + self.face_landmark_inf_time + self.iris_inf_time)/3)
-        self.inference_averages.append(average)
-
-        if len(self.inference_averages) > self.sample_size:
-            self.inference_averages.pop(0)
+    def histogram(self, model, backend):
+        """Return the histogram for model on backend, created on first use"""
+        key = (model, backend)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            return histogram
 
+    def stats(self):
+        """Nested {model: {backend: stats}} of every recorded histogram"""
+        with self.lock:
+            items = sorted(self.histograms.items())
+        stats = {}
+        for (model, backend), histogram in items:
+            stats.setdefault(model, {})[backend] = histogram.stats()
+        return stats
 
-    def get_models_inf_average(self):
-        return sum(self.inference_averages) / len(self.inference_averages) if self.inference_averages else 0
+    def summary(self, stats=None):
+        """One line per model and backend, for display; stats -- stats() to show, e.g. from the inference worker"""
+        if stats is None:
+            stats = self.stats()
+        lines = []
+        for model, backends in stats.items():
+            for backend, s in backends.items():
+                if s["count"]:
+                    lines.append("{} ({}): p50 {:.2f} / p95 {:.2f} / p99 {:.2f} ms, n={}".format(
+                        model, backend, s["p50"], s["p95"], s["p99"], s["count"]))
+        return "\n".join(lines)
@@ -26,4 +26,27 @@ NPU_MODELS = {
     'LANDMARK_MODEL': 'face_landmark_192_integer_quant_vela.tflite',
     'EYE_MODEL': 'iris_landmark_quant_vela.tflite',
     'YOLO_MODEL': 'yolov4_tiny_smk_call_vela.tflite'
-}
\ No newline at end of file
+}
+
+NPU_DELEGATE = "/usr/lib/libethosu_delegate.so"
+
+MODELS = {
+    'CPU': CPU_MODELS,
+    'NPU': NPU_MODELS
+}
+
+DELEGATES = {
+    'CPU': None,
+    'NPU': NPU_DELEGATE
+}
+
+PLACEMENT_PROFILE = os.path.join(model_dir, "placement_profile.json")
+
+RUNNER_CONFIG = os.path.join(model_dir, "runner_config.json")
+
+MODEL_NAMES = {
+    'DETECT_MODEL': 'face_detection',
+    'LANDMARK_MODEL': 'face_landmark',
+    'EYE_MODEL': 'iris_landmark',
+    'YOLO_MODEL': 'smoking_calling'
+}
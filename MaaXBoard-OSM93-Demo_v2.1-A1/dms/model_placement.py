@@ -0,0 +1,171 @@
+import os
+import json
+import threading
+import numpy as np
+
+from dms import model_paths
+from dms.model_runner import ModelRunner
+
+MODEL_KEYS = ('DETECT_MODEL', 'LANDMARK_MODEL', 'EYE_MODEL', 'YOLO_MODEL')
+""" Models of the DMS pipeline that are placed independently """
+
+PROFILE_WARMUP = 3
+""" Untimed invokes before measuring, the first NPU invoke includes command stream setup """
+
+PROFILE_ITERATIONS = 20
+""" Timed invokes per model and device """
+
+
+def benchmark_model(model_path, delegate_path, run_on_hardware, warmup=PROFILE_WARMUP, iterations=PROFILE_ITERATIONS,
+                    num_threads=None, cpu_delegate=None):
+    """
+    Returns the median invoke time of a model in ms, or None if it cannot run
+
+    Arguments:
+    model_path -- path to the .tflite model
+    delegate_path -- external delegate to load, None for the CPU kernels
+    run_on_hardware -- use tflite_runtime instead of tensorflow.lite
+    warmup -- untimed invokes before measuring
+    iterations -- timed invokes
+    num_threads -- CPU threads, None for the configured default
+    cpu_delegate -- CPU kernels ("xnnpack" or "builtin"), None for the configured default
+    """
+    if not os.path.exists(model_path):
+        return None
+
+    try:
+        # no name, profiling runs must not show up in the inference timings
+        runner = ModelRunner(None, model_path, delegate_path, run_on_hardware,
+                             num_threads=num_threads, cpu_delegate=cpu_delegate, warmup=0)
+        interpreter = runner.interpreter
+
+        for details in runner.input_details:
+            interpreter.set_tensor(details['index'], np.zeros(details['shape'], dtype=details['dtype']))
+
+        for _ in range(warmup):
+            runner.invoke()
+
+        times = [runner.invoke() * 1000 for _ in range(iterations)]
+    except (RuntimeError, ValueError) as e:
+        print("Cannot profile {}: {}".format(os.path.basename(model_path), e))
+        return None
+
+    return float(np.median(times))
+
+
+class ModelPlacement:
+    """
+    Assigns each DMS model to the device it runs fastest on.
+
+    Every model is benchmarked on every available device (CPU always, NPU when
+    the Ethos-U delegate is present) and the results are cached in a JSON
+    profile next to the models, so later starts only re-profile when a model
+    file changes. Models that could not be measured anywhere keep the default
+    device (NPU when available).
+
+    Arguments:
+    run_on_hardware -- use tflite_runtime and the board delegates
+    profile_path -- JSON profile cache, None to always profile
+    iterations -- timed invokes per model and device
+    """
+
+    def __init__(self, run_on_hardware=False, profile_path=model_paths.PLACEMENT_PROFILE,
+                 iterations=PROFILE_ITERATIONS):
+        self.run_on_hardware = run_on_hardware
+        self.profile_path = profile_path
+        self.iterations = iterations
+        self.devices = self.available_devices()
+        self.default_device = "NPU" if "NPU" in self.devices else "CPU"
+        self.latencies = None
+        self.plan = None
+        self.lock = threading.Lock()
+
+    def available_devices(self):
+        devices = ["CPU"]
+        if self.run_on_hardware and os.path.exists(model_paths.NPU_DELEGATE):
+            devices.append("NPU")
+        return devices
+
+    def load(self):
+        """Profile the models, or read the cached profile, once"""
+        with self.lock:
+            if self.plan is not None:
+                return self.plan
+
+            signature = self.signature()
+            self.latencies = self.read_profile(signature)
+            if self.latencies is None:
+                self.latencies = self.profile()
+                self.write_profile(signature)
+
+            self.plan = {}
+            for key in MODEL_KEYS:
+                measured = {device: ms for device, ms in self.latencies[key].items()
+                            if ms is not None and device in self.devices}
+                self.plan[key] = min(measured, key=measured.get) if measured else self.default_device
+            print("DMS model placement: {}".format(self.plan))
+            return self.plan
+
+    def device(self, key):
+        return self.load()[key]
+
+    def model_file(self, key):
+        """Returns (model_path, delegate_path) of a model on its assigned device"""
+        device = self.device(key)
+        return model_paths.MODEL_DIR + model_paths.MODELS[device][key], model_paths.DELEGATES[device]
+
+    def profile(self):
+        latencies = {}
+        for key in MODEL_KEYS:
+            latencies[key] = {}
+            for device in self.devices:
+                latencies[key][device] = benchmark_model(model_paths.MODEL_DIR + model_paths.MODELS[device][key],
+                                                         model_paths.DELEGATES[device],
+                                                         self.run_on_hardware,
+                                                         iterations=self.iterations)
+        return latencies
+
+    def signature(self):
+        """Model files and sizes per device, a changed model invalidates the profile"""
+        signature = {}
+        for device in self.devices:
+            for key in MODEL_KEYS:
+                name = model_paths.MODELS[device][key]
+                path = model_paths.MODEL_DIR + name
+                signature[device + "/" + key] = [name, os.path.getsize(path) if os.path.exists(path) else None]
+        return signature
+
+    def read_profile(self, signature):
+        if not self.profile_path or not os.path.exists(self.profile_path):
+            return None
+        try:
+            with open(self.profile_path) as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if profile.get("signature") != signature:
+            return None
+        return profile["latencies"]
+
+    def write_profile(self, signature):
+        if not self.profile_path:
+            return
+        try:
+            with open(self.profile_path, "w") as f:
+                json.dump({"signature": signature, "latencies": self.latencies}, f, indent=2)
+        except OSError as e:
+            print("Cannot write placement profile: {}".format(e))
+
+    def stats(self):
+        """Chosen device and measured ms per device for every model"""
+        with self.lock:
+            if self.plan is None:
+                return {}
+            return {
+                key: {
+                    "device": self.plan[key],
+                    "latency_ms": {device: (round(ms, 2) if ms is not None else None)
+                                   for device, ms in self.latencies[key].items()},
+                }
+                for key in MODEL_KEYS
+            }
@@ -0,0 +1,161 @@
+import gc
+import time
+import threading
+import contextlib
+import psutil
+
+from dms.dms_manager import DMSManager
+
+
+class DMSModelRegistry:
+    """
+    Lazily constructs DMSManager backends (CPU or NPU) on first use.
+
+    Loading a backend creates four TFLite interpreters plus their delegates, so
+    nothing is loaded until a backend is requested with get() or prewarm().
+    When a memory budget is set, the least recently used backend other than the
+    one being requested is evicted once the measured resident size of the loaded
+    backends goes over budget. Backends held with use() are never evicted, the
+    eviction is retried when they are released.
+
+    When a ModelPlacement is given, the NPU backend places each model on its
+    fastest device instead of forcing all of them onto the NPU.
+
+    Arguments:
+    run_on_hardware -- passed through to DMSManager
+    memory_budget_mb -- max resident MB for all loaded backends, None to keep all
+    placement -- ModelPlacement used by the NPU backend, None for NPU only
+    """
+
+    def __init__(self, run_on_hardware=False, memory_budget_mb=None, placement=None):
+        self.run_on_hardware = run_on_hardware
+        self.memory_budget_mb = memory_budget_mb
+        self.placement = placement
+        self.backends = {}
+        self.backend_sizes_mb = {}
+        self.load_times = {}
+        self.lock = threading.Lock()
+        self.load_locks = {False: threading.Lock(), True: threading.Lock()}
+        self.use_order = []
+        self.in_use = {False: 0, True: 0}
+
+    def get(self, use_npu):
+        """Return the backend for use_npu, loading it first if needed"""
+        use_npu = bool(use_npu)
+        with self.lock:
+            backend = self.backends.get(use_npu)
+            if backend is not None:
+                self._touch(use_npu)
+                return backend
+
+        with self.load_locks[use_npu]:
+            # another thread may have finished loading while we waited
+            with self.lock:
+                backend = self.backends.get(use_npu)
+            if backend is None:
+                backend = self._load(use_npu)
+
+        with self.lock:
+            self._touch(use_npu)
+            self._enforce_budget(keep=use_npu)
+        return backend
+
+    @contextlib.contextmanager
+    def use(self, use_npu):
+        """Hold the backend for use_npu while running it, so another thread cannot evict and close it"""
+        use_npu = bool(use_npu)
+        while True:
+            backend = self.get(use_npu)
+            with self.lock:
+                # it may have been evicted between get() and here
+                if self.backends.get(use_npu) is backend:
+                    self.in_use[use_npu] += 1
+                    break
+        try:
+            yield backend
+        finally:
+            with self.lock:
+                self.in_use[use_npu] -= 1
+                self._enforce_budget(keep=self.use_order[-1] if self.use_order else use_npu)
+
+    def prewarm(self, use_npu):
+        """Load a backend on a background thread so the first frame does not wait"""
+        if self.is_loaded(use_npu):
+            return None
+        thread = threading.Thread(target=self.get, args=(use_npu,), daemon=True)
+        thread.start()
+        return thread
+
+    def evict(self, use_npu):
+        """Drop a backend so its interpreters and delegates can be released, returns False while it is in use"""
+        use_npu = bool(use_npu)
+        with self.lock:
+            if self.in_use[use_npu]:
+                return False
+            backend = self.backends.pop(use_npu, None)
+            self.backend_sizes_mb.pop(use_npu, None)
+            if use_npu in self.use_order:
+                self.use_order.remove(use_npu)
+        if backend is not None:
+            backend.close()
+            del backend
+            gc.collect()
+        return True
+
+    def is_loaded(self, use_npu):
+        with self.lock:
+            return bool(use_npu) in self.backends
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                ("NPU" if use_npu else "CPU"): {
+                    "size_mb": round(self.backend_sizes_mb.get(use_npu, 0.0), 1),
+                    "load_s": round(self.load_times.get(use_npu, 0.0), 2),
+                    "plan": self.backends[use_npu].model_plan,
+                    "cascade": self.backends[use_npu].cascade.stats(),
+                }
+                for use_npu in self.backends
+            }
+        if self.placement is not None:
+            stats["placement"] = self.placement.stats()
+        return stats
+
+    def _load(self, use_npu):
+        process = psutil.Process()
+        rss_before = process.memory_info().rss
+        start = time.time()
+        placement = self.placement if use_npu else None
+        backend = DMSManager(run_on_hardware=self.run_on_hardware, use_npu=use_npu, placement=placement)
+        end = time.time()
+        size_mb = max(process.memory_info().rss - rss_before, 0) / (1024 * 1024)
+
+        with self.lock:
+            self.backends[use_npu] = backend
+            self.backend_sizes_mb[use_npu] = size_mb
+            self.load_times[use_npu] = end - start
+        print("DMS {} backend loaded in {:.2f} s ({:.1f} MB)".format("NPU" if use_npu else "CPU", end - start, size_mb))
+        return backend
+
+    def _touch(self, use_npu):
+        if use_npu in self.use_order:
+            self.use_order.remove(use_npu)
+        self.use_order.append(use_npu)
+
+    def _enforce_budget(self, keep):
+        if self.memory_budget_mb is None:
+            return
+        evicted = False
+        for use_npu in list(self.use_order):
+            if sum(self.backend_sizes_mb.values()) <= self.memory_budget_mb:
+                break
+            if use_npu == keep or self.in_use[use_npu]:
+                # a backend in use is evicted once it is released
+                continue
+            self.backends.pop(use_npu).close()
+            self.backend_sizes_mb.pop(use_npu, None)
+            self.use_order.remove(use_npu)
+            evicted = True
+            print("DMS {} backend evicted".format("NPU" if use_npu else "CPU"))
+        if evicted:
+            gc.collect()
@@ -0,0 +1,184 @@
+import json
+import os
+import time
+
+from dms import model_paths
+from dms.inference_timer import InferenceTimeLogger
+from dms.utils import dequantize
+
+CPU_DELEGATES = ("xnnpack", "builtin")
+""" CPU kernels: "xnnpack" lets TFLite apply its default XNNPACK delegate, "builtin" the plain kernels only """
+
+DEFAULT_SETTINGS = {"num_threads": None, "cpu_delegate": "xnnpack", "warmup": 1}
+""" Runner settings of models without an entry in the runner config """
+
+
+def load_tflite(run_on_hardware):
+    """tflite_runtime on the board, the full tensorflow.lite on a desktop"""
+    if run_on_hardware:
+        import tflite_runtime.interpreter as tflite
+    else:
+        import tensorflow.lite as tflite
+    return tflite
+
+
+def load_runner_config(path=model_paths.RUNNER_CONFIG):
+    """
+    Per model runner settings as written by autotune.py, {} when there are none
+
+    The config maps model name and backend to settings, e.g.
+    {"face_detection": {"CPU": {"num_threads": 2, "cpu_delegate": "xnnpack"}}}
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print("Cannot read runner config: {}".format(e))
+        return {}
+
+
+def save_runner_config(config, path=model_paths.RUNNER_CONFIG):
+    with open(path, "w") as f:
+        json.dump(config, f, indent=2)
+
+
+class ModelRunner:
+    """
+    A TFLite model with its interpreter, delegates, tensor bindings and timing.
+
+    The interpreter comes from tflite_runtime on the board (tensorflow.lite on
+    a desktop). With a delegate path the external delegate (e.g. Ethos-U) is
+    loaded, otherwise the model runs on the CPU kernels selected by
+    cpu_delegate. num_threads applies to the CPU kernels in both cases.
+    Settings not given explicitly come from the runner config, then from
+    DEFAULT_SETTINGS.
+
+    Inputs and outputs are bound to zero copy tensor views after every
+    allocation; outputs by tensor name. Every invoke() is recorded in the
+    model's InferenceTimeLogger histogram and passed to the timing hooks.
+
+    Arguments:
+    name -- model name for timing and config lookup, e.g. "face_detection", None for no timing
+    model_path -- path to the .tflite model
+    delegate_path -- external delegate to load, None to run on the CPU
+    run_on_hardware -- use tflite_runtime instead of tensorflow.lite
+    num_threads -- CPU threads, None for the configured or TFLite default
+    cpu_delegate -- "xnnpack" or "builtin", None for the configured one
+    warmup -- untimed invokes after loading, None for the configured number
+    backend -- histogram and config backend, defaults to NPU with a delegate and CPU without
+    config -- runner config (see load_runner_config), None to read the default one
+    timer_name -- histogram name, defaults to name
+    """
+
+    def __init__(self, name, model_path, delegate_path=None, run_on_hardware=False, num_threads=None,
+                 cpu_delegate=None, warmup=None, backend=None, config=None, timer_name=None):
+        self.name = name
+        self.model_path = model_path
+        self.delegate_path = delegate_path
+        self.run_on_hardware = run_on_hardware
+        self.backend = backend or ("NPU" if delegate_path else "CPU")
+
+        if config is None:
+            config = load_runner_config()
+        settings = dict(DEFAULT_SETTINGS)
+        settings.update(config.get(name, {}).get(self.backend, {}))
+        for key, value in (("num_threads", num_threads), ("cpu_delegate", cpu_delegate), ("warmup", warmup)):
+            if value is not None:
+                settings[key] = value
+        if settings["cpu_delegate"] not in CPU_DELEGATES:
+            raise ValueError("cpu_delegate must be one of " + ", ".join(CPU_DELEGATES))
+        self.num_threads = settings["num_threads"]
+        self.cpu_delegate = settings["cpu_delegate"]
+        self.warmup = settings["warmup"]
+
+        timer_name = timer_name or name
+        self.timer = InferenceTimeLogger().histogram(timer_name, self.backend) if timer_name else None
+        self.hooks = []
+        self.interpreter = None
+        self.load()
+
+    def create_interpreter(self):
+        tflite = load_tflite(self.run_on_hardware)
+        kwargs = {"model_path": self.model_path, "num_threads": self.num_threads}
+        if self.delegate_path:
+            kwargs["experimental_delegates"] = [tflite.load_delegate(self.delegate_path)]
+        if self.cpu_delegate == "builtin":
+            # tensorflow.lite keeps the resolver types under experimental
+            resolvers = getattr(tflite, "OpResolverType", None) or tflite.experimental.OpResolverType
+            kwargs["experimental_op_resolver_type"] = resolvers.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+        return tflite.Interpreter(**kwargs)
+
+    def load(self):
+        """(Re)create the interpreter, allocate, bind and warm it up"""
+        self.interpreter = self.create_interpreter()
+        self.interpreter.allocate_tensors()
+        self.bind()
+        if self.warmup:
+            start = time.perf_counter()
+            for _ in range(self.warmup):
+                self.interpreter.invoke()
+            print("{} warm up time: {:.1f} ms".format(self.name or os.path.basename(self.model_path),
+                                                      (time.perf_counter() - start) * 1000))
+
+    def bind(self):
+        """
+        Refresh the tensor details and views, needed after every allocation
+
+        input_views and output_views hold the callables of interpreter.tensor(),
+        the arrays they return must be dropped before the next invoke.
+        """
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.outputs = {output['name']: output for output in self.output_details}
+        self.input_views = [self.interpreter.tensor(details['index']) for details in self.input_details]
+        self.output_views = {output['name']: self.interpreter.tensor(output['index']) for output in self.output_details}
+
+    def resize_input(self, shape, index=0):
+        """Resize an input and reallocate, returns False (and starts over) if the model cannot be resized"""
+        try:
+            self.interpreter.resize_tensor_input(self.input_details[index]['index'], shape)
+            self.interpreter.allocate_tensors()
+        except Exception:
+            # fixed shape model (e.g. Vela compiled)
+            self.load()
+            return False
+        self.bind()
+        return True
+
+    @property
+    def input_shape(self):
+        """(height, width) of the first input"""
+        return self.input_details[0]['shape'][1:3]
+
+    def output(self, name):
+        """Float values of an output by tensor name"""
+        return dequantize(self.output_views[name](), self.outputs[name])
+
+    def output_at(self, index):
+        """Float values of an output by position"""
+        return self.output(self.output_details[index]['name'])
+
+    def add_timing_hook(self, hook):
+        """hook(name, backend, seconds) is called after every invoke"""
+        self.hooks.append(hook)
+
+    def invoke(self):
+        start = time.perf_counter()
+        self.interpreter.invoke()
+        delta = time.perf_counter() - start
+        if self.timer is not None:
+            self.timer.record(delta)
+        for hook in self.hooks:
+            hook(self.name, self.backend, delta)
+        return delta
+
+    def settings(self):
+        return {
+            "model": os.path.basename(self.model_path),
+            "backend": self.backend,
+            "num_threads": self.num_threads,
+            "cpu_delegate": self.cpu_delegate,
+            "warmup": self.warmup,
+        }
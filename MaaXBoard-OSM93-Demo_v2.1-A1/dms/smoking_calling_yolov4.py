@@ -7,9 +7,11 @@ SPDX-License-Identifier: BSD-3-Clause
 This script define class of smoking/calling detection used in DMS demo
 """
 import time
+import threading
 import numpy as np
-import tflite_runtime.interpreter as tflite
 import cv2
+from dms.utils import make_input_lut, fill_input_tensor
+from dms.model_runner import ModelRunner
 
 ANCHORS_TINY = [23, 27, 37, 58, 81, 82, 81, 82, 135, 169, 344, 319]
 STRIDES = [16, 32]
@@ -35,19 +37,18 @@ class SmokingCallingDetector:
         """
 
         print(model_path)
+        delegate_path = None
         if inf_device == "NPU":
             if platform == "i.MX8MP":
-                delegate = tflite.load_delegate("/usr/lib/libvx_delegate.so")
+                delegate_path = "/usr/lib/libvx_delegate.so"
             elif platform == "i.MX93":
-                delegate = tflite.load_delegate("/usr/lib/libethosu_delegate.so")
+                delegate_path = "/usr/lib/libethosu_delegate.so"
             else:
                 print("Platform not supported!")
                 return
-            self.interpreter = tflite.Interpreter(
-                model_path=model_path, experimental_delegates=[delegate]
-            )
-        else:
-            self.interpreter = tflite.Interpreter(model_path=model_path)
+        self.runner = ModelRunner("smoking_calling", model_path, delegate_path,
+                                  run_on_hardware=True, backend=inf_device)
+        self.inference_timer = self.runner.timer
 
         self.nms_threshold = iou
         self.conf_threshold = conf
@@ -57,23 +58,30 @@ class SmokingCallingDetector:
         self.raw_frame_height = 0
         self.result = []
 
-        self.interpreter.allocate_tensors()
-        # model warm up
-        time_start = time.time()
-        self.interpreter.invoke()
-        time_end = time.time()
-        print("smk/calling model warm up time:")
-        print((time_end - time_start) * 1000, " ms")
-
-        self.input_details = self.interpreter.get_input_details()
+        self.input_details = self.runner.input_details
         self.input_height = self.input_details[0]["shape"][1]
         self.input_width = self.input_details[0]["shape"][2]
         self.input_type = self.input_details[0]["dtype"]
+        # integer models are fed directly, x / 255 folded into the lut
+        self.input_lut = make_input_lut(self.input_details[0], 1 / 255.0, 0.0)
+
+        self.output_details = self.runner.output_details
 
-        self.output_details = self.interpreter.get_output_details()
+        # preprocessing writes straight into the interpreter's input buffer
+        # and outputs are read through views instead of get_tensor copies
+        self.input_tensor = self.runner.input_views[0]
+        self.resized = np.empty((self.input_height, self.input_width, 3), dtype=np.uint8)
+        self.resized_rgb = np.empty_like(self.resized)
 
-    def inference(self, input_image, mono):
-        """Detect smoking and calling behavior from input_image and return the bounding box"""
+    def inference(self, input_image, mono, views=None):
+        """
+        Detect smoking and calling behavior from input_image and return the bounding box
+
+        Arguments:
+        input_image -- the BGR frame
+        mono -- the frame is single channel (not supported yet)
+        views -- optional FrameViews of input_image, to share the model size RGB resize
+        """
         raw_frame_shape = input_image.shape
         self.raw_frame_width = raw_frame_shape[1]
         self.raw_frame_height = raw_frame_shape[0]
@@ -81,23 +89,21 @@ class SmokingCallingDetector:
         # preprocess
         if mono:
             print("not supported yet")
+            return np.array([])
+        elif views is not None:
+            resized_rgb = views.Resized((self.input_width, self.input_height), rgb=True)
         else:
-            original_image = cv2.cvtColor(input_image, cv2.COLOR_BGR2RGB)
-            resized_img_rgb = cv2.resize(
-                original_image, (self.input_width, self.input_height)
+            # resize first, the channel swap then only touches the small image
+            cv2.resize(
+                input_image, (self.input_width, self.input_height), dst=self.resized
             )
-            input_data = np.float32(resized_img_rgb) / 255.0
+            resized_rgb = cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=self.resized_rgb)
 
         # send data
-        self.interpreter.set_tensor(
-            self.input_details[0]["index"], np.expand_dims(input_data, axis=0)
-        )
+        fill_input_tensor(self.input_tensor, resized_rgb, self.input_lut, 1 / 255.0, 0.0)
         # inference
-        self.interpreter.invoke()
-        pred = [
-            self.interpreter.get_tensor(self.output_details[i]["index"])
-            for i in range(len(self.output_details))
-        ]
+        self.runner.invoke()
+        pred = [self.runner.output_at(i) for i in range(len(self.output_details))]
 
         # postprocess
         self.result = self.filter_boxes(pred[1], pred[0])
@@ -259,3 +265,75 @@ class SmokingCallingDetector:
                 )
 
         cv2.imwrite("img_out_test.jpg", input_image)
+
+
+class AsyncSmokingCallingDetector:
+    """Runs a SmokingCallingDetector on its own thread at a fixed rate"""
+
+    def __init__(self, detector, rate_hz=3.0):
+        """
+        Creates a rate-decoupled wrapper around a smoking/calling detector
+
+        Arguments:
+        detector -- the SmokingCallingDetector to run
+        rate_hz -- the max number of detections per second
+        """
+        self.detector = detector
+        self.period = 1.0 / rate_hz
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_views = None
+        self.frame_time = 0
+        self.result = np.array([])
+        self.result_time = None
+        self.runs = 0
+        self.running = True
+        self.worker = threading.Thread(target=self.run, name="smk-call-detector", daemon=True)
+        self.worker.start()
+
+    def submit(self, input_image, views=None):
+        """Offer the newest frame, replacing any frame not yet picked up"""
+        with self.condition:
+            self.frame = input_image
+            self.frame_views = views
+            self.frame_time = time.monotonic()
+            self.condition.notify()
+
+    def latest(self):
+        """Return the last detection result and the capture time of its frame"""
+        with self.condition:
+            return self.result, self.result_time
+
+    def run(self):
+        last_run = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.frame is not None or not self.running)
+                if not self.running:
+                    return
+            # throttle to the configured rate, then take the newest frame
+            delay = last_run + self.period - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self.condition:
+                frame, views, frame_time = self.frame, self.frame_views, self.frame_time
+                self.frame = None
+                self.frame_views = None
+            if frame is None:
+                continue
+
+            last_run = time.monotonic()
+            try:
+                result = self.detector.inference(frame, False, views)
+            except Exception as e:
+                print("smk/calling detection error:", e)
+                continue
+            with self.condition:
+                self.result = result
+                self.result_time = frame_time
+                self.runs += 1
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
@@ -86,6 +86,67 @@ def get_eye_boxes(landmarks, size, scale = 1.5):
     right_box = get_box(landmarks, RIGHT_EYE_POINT, scale)
     return left_box, right_box
 
+def make_input_lut(input_details, scale, offset):
+    """
+    Build a 256 entry lookup table mapping uint8 pixels straight to the model's
+    integer input values, folding the float normalization (pixel * scale + offset)
+    into the input quantization. Returns None for float input models.
+    """
+    dtype = input_details['dtype']
+    if not np.issubdtype(dtype, np.integer):
+        return None
+
+    q_scale, zero_point = input_details['quantization']
+    if q_scale:
+        values = (np.arange(256) * scale + offset) / q_scale + zero_point
+    else:
+        # no quantization parameters, model consumes raw pixels
+        values = np.arange(256)
+    info = np.iinfo(dtype)
+    return np.clip(np.round(values), info.min, info.max).astype(dtype)
+
+def fill_input_tensor(input_tensor, resized, lut, scale, offset, batch=0):
+    """
+    Write a resized uint8 image straight into the interpreter's input buffer.
+    input_tensor is the callable returned by interpreter.tensor(); the view it
+    returns is dropped on return so the interpreter is safe to invoke.
+    """
+    input_view = input_tensor()[batch]
+    if lut is not None:
+        np.take(lut, resized, out=input_view)
+    else:
+        np.multiply(resized, scale, out=input_view, casting='unsafe')
+        if offset:
+            input_view += offset
+
+def dequantize(tensor, output_details):
+    """Convert an integer output tensor back to float, float outputs are returned as is"""
+    if not np.issubdtype(output_details['dtype'], np.integer):
+        return tensor
+    q_scale, zero_point = output_details['quantization']
+    if not q_scale:
+        return tensor.astype(np.float32)
+    return (tensor.astype(np.float32) - zero_point) * q_scale
+
+def track_detection(bbox, landmark, keyframe_mesh, mesh):
+    """
+    Move a face detection (bbox and 6 keypoints) from the keyframe it was detected
+    on to the current frame, using the similarity transform between the face mesh
+    of the keyframe and the current face mesh. Lets the next frame be aligned
+    without running the face detector.
+    """
+    M, _ = cv2.estimateAffinePartial2D(np.ascontiguousarray(keyframe_mesh[:, :2], dtype=np.float32),
+                                       np.ascontiguousarray(mesh[:, :2], dtype=np.float32))
+    if M is None:
+        return None, None
+
+    corners = np.array([[bbox[0], bbox[1]], [bbox[2], bbox[1]],
+                        [bbox[0], bbox[3]], [bbox[2], bbox[3]]])
+    corners = corners @ M[:, :2].T + M[:, 2]
+    points = landmark.reshape(-1, 2) @ M[:, :2].T + M[:, 2]
+    tracked_bbox = np.concatenate([corners.min(axis=0), corners.max(axis=0)])
+    return tracked_bbox, points.reshape(-1)
+
 def nms_oneclass(bbox, score, thresh = 0.4):
     x1 = bbox[:, 0]
     y1 = bbox[:, 1]
@@ -0,0 +1,290 @@
+import time
+import threading
+import collections
+from dms.inference_timer import LatencyHistogram
+
+
+class DropOldestQueue():
+	''' Small bounded queue that discards the oldest entry when full.
+
+	Stages of the frame pipeline only ever care about the newest frame, so a
+	slow consumer must never block its producer. Instead the stale frame is
+	dropped and counted.
+
+	Args:
+		maxsize (int): Maximum number of queued items. Defaults to 2.
+	'''
+
+	def __init__(self, maxsize = 2):
+		self.maxsize = max(1, maxsize)
+		self.items = collections.deque()
+		self.condition = threading.Condition()
+		self.dropped = 0
+		self.closed = False
+
+	def put(self, item):
+		with self.condition:
+			if len(self.items) >= self.maxsize:
+				self.items.popleft()
+				self.dropped += 1
+			self.items.append(item)
+			self.condition.notify()
+
+	def get(self, timeout = None):
+		''' Returns the oldest queued item, or None on timeout/close. '''
+		with self.condition:
+			if not self.condition.wait_for(lambda: self.items or self.closed, timeout):
+				return None
+			if self.items:
+				return self.items.popleft()
+			return None
+
+	def qsize(self):
+		with self.condition:
+			return len(self.items)
+
+	def clear(self):
+		with self.condition:
+			self.items.clear()
+
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+
+
+class LatencyTracker():
+	''' Capture-to-consumer latency of frames, and the latency budget.
+
+	Every consumer (inference, frame callback, display, MJPEG encoder) records
+	how long after capture it got the frame, giving per consumer percentiles.
+	With a budget set, pipeline stages drop frames that already missed it
+	instead of spending time on them.
+
+	Args:
+		budget (float): Max seconds from capture before a frame is dropped,
+			None to never drop.
+	'''
+
+	def __init__(self, budget = None):
+		self.budget = budget
+		self.histograms = {}
+		self.lock = threading.Lock()
+
+	def Expired(self, captureTime):
+		return self.budget is not None and captureTime is not None and time.monotonic() - captureTime > self.budget
+
+	def Record(self, consumer, captureTime):
+		if captureTime is None:
+			return
+		with self.lock:
+			histogram = self.histograms.get(consumer)
+			if histogram is None:
+				histogram = self.histograms[consumer] = LatencyHistogram()
+		histogram.record(time.monotonic() - captureTime)
+
+	def stats(self):
+		with self.lock:
+			items = list(self.histograms.items())
+		return {
+			"budget_ms": round(self.budget * 1000, 1) if self.budget is not None else None,
+			"consumers": {consumer: histogram.stats() for consumer, histogram in items},
+		}
+
+
+class PipelineFrame():
+	''' Unit of work passed between pipeline stages.
+
+	Attributes:
+		seq (int): Monotonic frame sequence number assigned at capture.
+		image (np.array): Frame data, replaced by each stage as it is transformed.
+		timestamp (float): Capture time reported by the frame source.
+		captureTime (float): time.monotonic() at capture, used for latency tracing.
+		views (FrameViews): Cached derived views of the preprocessed image.
+		demo (int): Demo selected when the frame was captured.
+		results (tuple): Demo specific results filled in by the inference stage.
+		callbackArgs (tuple): Arguments for the frame callback, filled in by annotate.
+	'''
+
+	def __init__(self, seq, image):
+		self.seq = seq
+		self.image = image
+		self.timestamp = None
+		self.captureTime = None
+		self.views = None
+		self.demo = None
+		self.results = None
+		self.callbackArgs = None
+
+
+class PipelineStage():
+	''' Single worker thread of the frame pipeline.
+
+	The worker pulls items from its input queue (or calls work() directly when
+	it is the source stage), and pushes non None results to the output queue.
+
+	Args:
+		name (str): Stage name used when reporting statistics.
+		work (callable): Function receiving an item and returning the next item,
+			or None to drop it.
+		inputQueue (DropOldestQueue): Queue to read from, None for source stages.
+		outputQueue (DropOldestQueue): Queue to write to, None for sink stages.
+		expired (callable): Returns True for items that missed their deadline,
+			which are dropped without being processed.
+	'''
+
+	RATE_WINDOW = 1.0
+
+	def __init__(self, name, work, inputQueue = None, outputQueue = None, expired = None):
+		self.name = name
+		self.work = work
+		self.inputQueue = inputQueue
+		self.outputQueue = outputQueue
+		self.expired = expired
+		self.running = False
+		self.thread = None
+		self.waiting = inputQueue is not None
+
+		self.processed = 0
+		self.errors = 0
+		self.late = 0
+		self.busyTime = 0.0
+		self.fps = 0.0
+		self.windowStart = time.monotonic()
+		self.windowCount = 0
+		self.lastLatency = 0.0
+
+	def start(self):
+		self.running = True
+		self.thread = threading.Thread(target=self.run, name="pipeline-" + self.name, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.running = False
+
+	def join(self, timeout = None):
+		if self.thread is not None:
+			self.thread.join(timeout)
+
+	def run(self):
+		while self.running:
+			if self.inputQueue is not None:
+				self.waiting = True
+				item = self.inputQueue.get(timeout=0.1)
+				if item is None:
+					continue
+				self.waiting = False
+				if self.expired is not None and self.expired(item):
+					self.late += 1
+					continue
+			else:
+				item = None
+
+			start = time.monotonic()
+			try:
+				result = self.work(item) if self.inputQueue is not None else self.work()
+			except Exception:
+				self.errors += 1
+				result = None
+			end = time.monotonic()
+
+			if result is None:
+				continue
+
+			self.record(end - start, end)
+			if self.outputQueue is not None:
+				self.outputQueue.put(result)
+
+	def record(self, delta, now):
+		self.processed += 1
+		self.busyTime += delta
+		self.lastLatency = delta
+		self.windowCount += 1
+		elapsed = now - self.windowStart
+		if elapsed >= self.RATE_WINDOW:
+			self.fps = self.windowCount / elapsed
+			self.windowStart = now
+			self.windowCount = 0
+
+	def stats(self):
+		return {
+			"queue_depth": self.inputQueue.qsize() if self.inputQueue is not None else 0,
+			"dropped": self.inputQueue.dropped if self.inputQueue is not None else 0,
+			"processed": self.processed,
+			"errors": self.errors,
+			"late": self.late,
+			"fps": round(self.fps, 2),
+			"avg_ms": round((self.busyTime / self.processed) * 1000, 2) if self.processed else 0.0,
+			"last_ms": round(self.lastLatency * 1000, 2),
+		}
+
+
+class FramePipeline():
+	''' Staged frame processor: capture -> preprocess -> inference -> annotate -> publish.
+
+	Each stage runs on its own thread and hands frames to the next stage through
+	a small DropOldestQueue, so capture keeps pulling frames while the CPU/NPU
+	is busy and every stage always works on the newest frame available.
+
+	Args:
+		capture (callable): Returns a new PipelineFrame, or None if none available.
+		preprocess (callable): Prepares a captured frame for inference.
+		inference (callable): Runs the selected demo on the frame.
+		annotate (callable): Builds the displayed frame and callback arguments.
+		publish (callable): Hands the finished frame to the application.
+		queueSize (int): Depth of each inter-stage queue. Defaults to 2.
+		latency (LatencyTracker): Budget that preprocess, inference and annotate
+			enforce on frames. Defaults to no budget.
+	'''
+
+	STAGE_NAMES = ("capture", "preprocess", "inference", "annotate", "publish")
+	DEADLINE_STAGES = ("preprocess", "inference", "annotate")
+
+	def __init__(self, capture, preprocess, inference, annotate, publish, queueSize = 2, latency = None):
+		works = (capture, preprocess, inference, annotate, publish)
+		self.queues = [DropOldestQueue(queueSize) for _ in range(len(works) - 1)]
+		self.latency = latency if latency is not None else LatencyTracker()
+
+		self.stages = []
+		for i, (name, work) in enumerate(zip(self.STAGE_NAMES, works)):
+			inputQueue = self.queues[i - 1] if i > 0 else None
+			outputQueue = self.queues[i] if i < len(self.queues) else None
+			expired = self.Expired if name in self.DEADLINE_STAGES else None
+			self.stages.append(PipelineStage(name, work, inputQueue, outputQueue, expired))
+
+	def start(self):
+		for stage in self.stages:
+			stage.start()
+
+	def stop(self, timeout = 2):
+		for stage in self.stages:
+			stage.stop()
+		for queue in self.queues:
+			queue.close()
+		for stage in self.stages:
+			if stage.thread is not threading.current_thread():
+				stage.join(timeout)
+
+	def Expired(self, frame):
+		return self.latency.Expired(frame.captureTime)
+
+	def WantsFrame(self, stageName = "inference"):
+		''' True when stageName is idle and no frame is queued ahead of it.
+
+		Lets a source that can skip decoding (e.g. V4L2 grab/retrieve) decode
+		only the frame that will actually be processed next.
+		'''
+		for stage in self.stages[1:]:
+			if stage.inputQueue.qsize() or not stage.waiting:
+				return False
+			if stage.name == stageName:
+				return True
+		return True
+
+	def flush(self):
+		''' Drops all in-flight frames, e.g. after the active demo changes. '''
+		for queue in self.queues:
+			queue.clear()
+
+	def stats(self):
+		return {stage.name: stage.stats() for stage in self.stages}
@@ -0,0 +1,361 @@
+import os
+import glob
+import time
+import cv2
+import numpy as np
+
+
+class FrameSource():
+	''' Base class for everything the capture stage can read frames from.
+
+	Subclasses implement OpenSource(), ReadFrame() and CloseSource(). Read()
+	paces frames to the requested rate and stamps each one, so a file or a
+	synthetic source can stand in for the camera with the same timing.
+
+	Args:
+		fps (float): Frames per second to deliver, None to deliver as fast as
+			the source produces them.
+		timestamps (str): "monotonic" stamps frames with time.monotonic() when
+			read, "media" with the frame's position in the source (index / fps),
+			which is identical between replays.
+
+	Attributes:
+		frameIndex (int): Number of frames read since the source was opened.
+	'''
+
+	TIMESTAMPS = ("monotonic", "media")
+
+	def __init__(self, fps = None, timestamps = "monotonic"):
+		if timestamps not in self.TIMESTAMPS:
+			raise ValueError("timestamps must be one of " + ", ".join(self.TIMESTAMPS))
+		self.fps = fps
+		self.timestamps = timestamps
+		self.frameIndex = 0
+		self.opened = False
+		self.startTime = None
+		self.grabTime = None
+
+	def Open(self):
+		self.opened = self.OpenSource()
+		self.frameIndex = 0
+		self.startTime = time.monotonic()
+		return self.opened
+
+	def IsOpened(self):
+		return self.opened
+
+	def Close(self):
+		if self.opened:
+			self.CloseSource()
+		self.opened = False
+
+	def Read(self):
+		''' Returns (image, timestamp) of the next frame, or (None, None) when none is available. '''
+		if not self.opened:
+			return None, None
+
+		self.Pace()
+		image = self.ReadFrame()
+		if image is None:
+			return None, None
+
+		if self.timestamps == "media":
+			timestamp = self.frameIndex / self.MediaFPS()
+		elif self.grabTime is not None:
+			timestamp = self.grabTime
+		else:
+			timestamp = time.monotonic()
+		self.grabTime = None
+		self.frameIndex += 1
+		return image, timestamp
+
+	def CanSkipDecode(self):
+		''' True if Grab() can advance the source without decoding the frame. '''
+		return False
+
+	def Grab(self):
+		return True
+
+	def Pace(self):
+		if not self.fps:
+			return
+		due = self.startTime + self.frameIndex / self.fps
+		delay = due - time.monotonic()
+		if delay > 0:
+			time.sleep(delay)
+		elif delay < -1.0 / self.fps:
+			# fell behind (e.g. slow consumer), restart the schedule instead of bursting
+			self.startTime = time.monotonic() - self.frameIndex / self.fps
+
+	def MediaFPS(self):
+		return self.fps or 30.0
+
+	def OpenSource(self):
+		raise NotImplementedError
+
+	def ReadFrame(self):
+		raise NotImplementedError
+
+	def CloseSource(self):
+		pass
+
+
+class V4L2Source(FrameSource):
+	''' Live camera capture through OpenCV's V4L2 backend.
+
+	The camera paces itself, so fps is requested from the driver rather than
+	enforced by sleeping.
+
+	In low latency mode the camera is asked for the smallest mode that still
+	covers width x height, preferring an uncompressed pixel format, with a
+	single driver buffer. Every camera frame is dequeued with Grab() but only
+	decoded by Read() when the caller wants one, so after a slow inference the
+	newest frame is decoded instead of a stale queued one.
+
+	Args:
+		device (int): V4L2 device index. Defaults to 0.
+		width (int): Requested capture width, the minimum one in low latency
+			mode. Defaults to 640.
+		height (int): Requested capture height, the minimum one in low latency
+			mode. Defaults to 480.
+		fps (float): Requested capture rate. Defaults to 30.
+		onHardware (bool): Running on the SBC, enables the hardware decode options.
+		lowLatency (bool): Negotiate the smallest mode and skip stale frames.
+	'''
+
+	LOW_LATENCY_SIZES = ((160, 120), (176, 144), (320, 240), (352, 288), (424, 240), (640, 360), (640, 480))
+	PIXEL_FORMATS = ("YUYV", "MJPG")
+
+	def __init__(self, device = 0, width = 640, height = 480, fps = 30, onHardware = False,
+				 lowLatency = False, timestamps = "monotonic"):
+		super().__init__(None, timestamps)
+		self.device = device
+		self.width = width
+		self.height = height
+		self.captureFPS = fps
+		self.onHardware = onHardware
+		self.lowLatency = lowLatency
+		self.grabbed = False
+		self.cap = None
+		self.captureSize = None
+		self.pixelFormat = None
+
+	def OpenSource(self):
+		try:
+			if self.onHardware == True:
+				os.environ['OPENCV_FFMPEG_CAPTURE_OPTIONS'] = 'hwaccel;qsv|video_codec;h264_qsv|vsync;0'
+
+			self.cap = cv2.VideoCapture(self.device, cv2.CAP_V4L2)
+			if self.lowLatency:
+				self.NegotiateLowLatency()
+			else:
+				self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+				self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+			self.cap.set(cv2.CAP_PROP_FPS, self.captureFPS)
+
+			# camera exposure - auto=3, manual=1
+			self.cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 3)
+			self.grabbed = False
+			return self.cap.isOpened()
+		except:
+			return False
+
+	def NegotiateLowLatency(self):
+		# the driver snaps to its nearest mode, so read back what was accepted
+		for width, height in self.LOW_LATENCY_SIZES:
+			if width < self.width or height < self.height:
+				continue
+			self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+			self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+			actual = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+			if actual[0] >= self.width and actual[1] >= self.height:
+				self.captureSize = actual
+				break
+
+		for pixelFormat in self.PIXEL_FORMATS:
+			fourcc = cv2.VideoWriter_fourcc(*pixelFormat)
+			self.cap.set(cv2.CAP_PROP_FOURCC, fourcc)
+			if int(self.cap.get(cv2.CAP_PROP_FOURCC)) == fourcc:
+				self.pixelFormat = pixelFormat
+				break
+
+		self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+		print("Camera low latency mode: {} {}".format(self.captureSize, self.pixelFormat))
+
+	def CanSkipDecode(self):
+		return self.lowLatency
+
+	def Grab(self):
+		''' Dequeues the next camera frame without decoding it. '''
+		self.grabbed = self.cap.grab()
+		if self.grabbed:
+			self.grabTime = time.monotonic()
+		return self.grabbed
+
+	def ReadFrame(self):
+		if self.grabbed:
+			self.grabbed = False
+			ret, image = self.cap.retrieve()
+		else:
+			self.grabTime = None
+			ret, image = self.cap.read()
+		return image if ret else None
+
+	def CloseSource(self):
+		try:
+			self.cap.release()
+		except:
+			pass
+
+	def MediaFPS(self):
+		return self.captureFPS
+
+
+class VideoFileSource(FrameSource):
+	''' Video file replay, looping back to the first frame at the end.
+
+	Args:
+		path (str): Video file to read.
+		fps (float): Delivery rate. Defaults to the file's own frame rate,
+			0 to deliver as fast as frames decode.
+		loop (bool): Restart at the end of the file. Defaults to True.
+	'''
+
+	def __init__(self, path, fps = None, loop = True, timestamps = "monotonic"):
+		super().__init__(fps, timestamps)
+		self.path = path
+		self.loop = loop
+		self.fileFPS = None
+		self.cap = None
+		self.useFileFPS = fps is None
+
+	def OpenSource(self):
+		self.cap = cv2.VideoCapture(self.path)
+		if not self.cap.isOpened():
+			return False
+		self.fileFPS = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+		if self.useFileFPS:
+			self.fps = self.fileFPS
+		return True
+
+	def ReadFrame(self):
+		ret, image = self.cap.read()
+		if not ret and self.loop:
+			self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+			ret, image = self.cap.read()
+		return image if ret else None
+
+	def CloseSource(self):
+		self.cap.release()
+
+	def MediaFPS(self):
+		return self.fps or self.fileFPS
+
+
+class ImageDirSource(FrameSource):
+	''' Image sequence replay from a directory, in file name order.
+
+	Args:
+		path (str): Directory holding the images.
+		fps (float): Delivery rate. Defaults to 30, None for as fast as possible.
+		loop (bool): Restart at the first image at the end. Defaults to True.
+		preload (bool): Decode every image once when opened so reads cost no I/O.
+	'''
+
+	PATTERNS = ("*.png", "*.jpg", "*.jpeg", "*.bmp")
+
+	def __init__(self, path, fps = 30, loop = True, preload = False, timestamps = "monotonic"):
+		super().__init__(fps, timestamps)
+		self.path = path
+		self.loop = loop
+		self.preload = preload
+		self.files = []
+		self.images = None
+		self.position = 0
+
+	def OpenSource(self):
+		self.files = sorted(f for pattern in self.PATTERNS for f in glob.glob(os.path.join(self.path, pattern)))
+		self.position = 0
+		if self.preload:
+			self.images = [image for image in (cv2.imread(f) for f in self.files) if image is not None]
+			return len(self.images) > 0
+		return len(self.files) > 0
+
+	def ReadFrame(self):
+		count = len(self.images) if self.images is not None else len(self.files)
+		# give up after a full pass without a single decodable image
+		for _ in range(count):
+			if self.position >= count:
+				if not self.loop:
+					return None
+				self.position = 0
+			index = self.position
+			self.position += 1
+			image = self.images[index] if self.images is not None else cv2.imread(self.files[index])
+			if image is not None:
+				return image
+		return None
+
+
+class SyntheticSource(FrameSource):
+	''' Generated test frames, a gradient with a moving box and the frame number.
+
+	Frames only depend on the frame index, so every run sees identical input.
+
+	Args:
+		width (int): Frame width. Defaults to 640.
+		height (int): Frame height. Defaults to 480.
+		fps (float): Delivery rate. Defaults to 30, None for as fast as possible.
+		frames (int): Frames before the source ends, None for endless.
+	'''
+
+	def __init__(self, width = 640, height = 480, fps = 30, frames = None, timestamps = "monotonic"):
+		super().__init__(fps, timestamps)
+		self.width = width
+		self.height = height
+		self.frames = frames
+		self.background = None
+
+	def OpenSource(self):
+		gradient = np.linspace(0, 255, self.width, dtype=np.uint8)
+		self.background = np.empty((self.height, self.width, 3), dtype=np.uint8)
+		self.background[:, :, 0] = gradient
+		self.background[:, :, 1] = gradient[::-1]
+		self.background[:, :, 2] = np.linspace(0, 255, self.height, dtype=np.uint8)[:, None]
+		return True
+
+	def ReadFrame(self):
+		if self.frames is not None and self.frameIndex >= self.frames:
+			return None
+		image = self.background.copy()
+		size = min(self.width, self.height) // 4
+		x = (self.frameIndex * 8) % max(self.width - size, 1)
+		y = (self.height - size) // 2
+		cv2.rectangle(image, (x, y), (x + size, y + size), (255, 255, 255), cv2.FILLED)
+		cv2.putText(image, str(self.frameIndex), (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+		return image
+
+
+def CreateFrameSource(spec, fps = None, loop = True, onHardware = False, lowLatency = False, timestamps = "monotonic"):
+	''' Builds a frame source from a short description.
+
+	Args:
+		spec (str): "v4l2" or "v4l2:<index>" for a camera, "synthetic" for
+			generated frames, a directory for an image sequence, anything else
+			is opened as a video file.
+		fps (float): Delivery rate, None for each source's default.
+		loop (bool): Loop file and image sources.
+		onHardware (bool): Passed to the V4L2 source.
+		lowLatency (bool): Open cameras in low latency mode, at 320x240 or the
+			smallest mode above it. Defaults to False, 640x480 downscaled.
+	'''
+	if spec is None or spec == "v4l2" or spec.startswith("v4l2:"):
+		device = int(spec.split(":", 1)[1]) if spec and ":" in spec else 0
+		if lowLatency:
+			return V4L2Source(device, 320, 240, fps=fps or 30, onHardware=onHardware, lowLatency=True, timestamps=timestamps)
+		return V4L2Source(device, fps=fps or 30, onHardware=onHardware, timestamps=timestamps)
+	if spec == "synthetic":
+		return SyntheticSource(fps=fps if fps is not None else 30, timestamps=timestamps)
+	if os.path.isdir(spec):
+		return ImageDirSource(spec, fps=fps if fps is not None else 30, loop=loop, timestamps=timestamps)
+	return VideoFileSource(spec, fps=fps, loop=loop, timestamps=timestamps)
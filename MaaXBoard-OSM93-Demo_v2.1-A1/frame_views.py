@@ -0,0 +1,100 @@
+import threading
+import functools
+import cv2
+import numpy as np
+
+
+@functools.lru_cache(maxsize=8)
+def LetterboxMirrorMatrix(width, height):
+	''' Affine map of the square, zero padded and mirrored view of a width x height frame.
+
+	Returns:
+		M (np.array): 2x3 matrix mapping view coordinates back to frame
+			coordinates, used both as the inverse map of the warp and to map
+			landmarks back analytically.
+		paddedSize (list): (top, bottom, left, right) padding.
+		size (int): Side of the square view.
+	'''
+	size = max(width, height)
+	paddedSize = [(size - height) // 2, (size - height + 1) // 2,
+				  (size - width) // 2, (size - width + 1) // 2]
+	# x = (size - 1 - left) - x', y = y' - top
+	M = np.array([[-1, 0, size - 1 - paddedSize[2]],
+				  [0, 1, -paddedSize[0]]], dtype=np.float32)
+	M.setflags(write=False)
+	return M, paddedSize, size
+
+
+class FrameViews():
+	''' Lazily computed, cached views of a single frame.
+
+	Every derived image (padded/mirrored square, RGB, model size resizes,
+	display RGBA) is computed the first time a consumer asks for it and then
+	shared, so each transform runs at most once per frame however many
+	consumers need it. Views are shared and must be treated as read only.
+
+	Args:
+		image (np.array): BGR frame the views are derived from.
+	'''
+
+	def __init__(self, image):
+		self.image = image
+		self.cache = {}
+		self.lock = threading.RLock()
+		self.computed = 0
+
+	def Get(self, key, compute):
+		''' Returns the view cached under key, calling compute() the first time. '''
+		with self.lock:
+			if key not in self.cache:
+				self.cache[key] = compute()
+				self.computed += 1
+			return self.cache[key]
+
+	def Padded(self):
+		''' Square, zero padded and mirrored frame, with the (top, bottom, left, right) pad. '''
+		return self.Get("padded", self.ComputePadded)
+
+	def ComputePadded(self):
+		# pad and mirror in a single pass, the matrix is cached per frame size
+		h, w = self.image.shape[:2]
+		M, paddedSize, size = LetterboxMirrorMatrix(w, h)
+		padded = cv2.warpAffine(self.image, M, (size, size),
+								flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+								borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0))
+		return padded, paddedSize
+
+	def PaddedToImage(self, points):
+		''' Maps (..., 2) points of the padded view back to frame coordinates. '''
+		h, w = self.image.shape[:2]
+		M = LetterboxMirrorMatrix(w, h)[0]
+		points = np.asarray(points, dtype=np.float32)
+		return points @ M[:, :2].T + M[:, 2]
+
+	def RGB(self):
+		return self.Get("rgb", lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB))
+
+	def Resized(self, size, rgb = False, padded = False):
+		''' Frame (or the padded view) resized to size=(width, height), optionally as RGB.
+
+		RGB resizes are converted after resizing so only the small image is swapped.
+		'''
+		size = tuple(int(s) for s in size)
+		key = ("resized", size, rgb, padded)
+		if rgb:
+			return self.Get(key, lambda: cv2.cvtColor(self.Resized(size, False, padded), cv2.COLOR_BGR2RGB))
+		source = self.Padded()[0] if padded else self.image
+		return self.Get(key, lambda: cv2.resize(source, size))
+
+	def DisplayRGBA(self):
+		''' Mirrored center crop (half width and height) as cairo ARGB32 (BGRA bytes). '''
+		return self.Get("display", self.ComputeDisplayRGBA)
+
+	def ComputeDisplayRGBA(self):
+		height, width = self.image.shape[:2]
+		margin_y, margin_x = int(height/4), int(width/4)
+		center_y, center_x = int(height/2), int(width/2)
+		# same pixels as cropping the mirrored frame, without mirroring all of it
+		crop = self.image[margin_y:center_y+margin_y, width-margin_x-center_x:width-margin_x]
+		crop = cv2.flip(crop, 1)
+		return cv2.cvtColor(crop, cv2.COLOR_BGR2BGRA)
@@ -0,0 +1,424 @@
+import time
+import queue
+import signal
+import itertools
+import threading
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+FRAME_SHAPE = (240, 320, 3)
+
+
+class SharedFrameRing():
+	''' Fixed size uint8 frame slots in one multiprocessing.shared_memory block.
+
+	The owner creates the block and hands out free slots; other processes
+	attach to it by name. Every slot has an input frame and an output frame,
+	written into and read from in place, so exchanging a frame between
+	processes costs a single copy and no pickling.
+
+	Args:
+		slots (int): Number of frame slots. Defaults to 4.
+		shape (tuple): Shape of every slot. Defaults to 240x320x3.
+		name (str): Name of an existing ring to attach to, None to create one.
+	'''
+
+	def __init__(self, slots = 4, shape = FRAME_SHAPE, name = None):
+		self.slots = slots
+		self.shape = tuple(shape)
+		self.owner = name is None
+		size = 2 * slots * int(np.prod(self.shape))
+		self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+		self.frames = np.ndarray((2 * slots,) + self.shape, dtype=np.uint8, buffer=self.memory.buf)
+		self.free = collections.deque(range(slots))
+		self.lock = threading.Lock()
+
+	@property
+	def name(self):
+		return self.memory.name
+
+	def Acquire(self):
+		''' Returns the index of a free slot, or None when all of them are in use. '''
+		with self.lock:
+			return self.free.popleft() if self.free else None
+
+	def Release(self, slot):
+		with self.lock:
+			self.free.append(slot)
+
+	def FreeSlots(self):
+		with self.lock:
+			return len(self.free)
+
+	def Fits(self, image):
+		return image is not None and image.shape == self.shape and image.dtype == np.uint8
+
+	def Write(self, slot, image):
+		if not self.Fits(image):
+			raise ValueError("frame must be a uint8 array of shape {}".format(self.shape))
+		np.copyto(self.frames[slot], image)
+
+	def Slot(self, slot):
+		return self.frames[slot]
+
+	def Output(self, slot):
+		return self.frames[self.slots + slot]
+
+	def Close(self):
+		# numpy views keep the buffer exported, drop them before closing
+		self.frames = None
+		self.memory.close()
+		if self.owner:
+			self.memory.unlink()
+
+
+class WorkerControl():
+	''' State shared between the parent and the inference worker.
+
+	Attributes:
+		ready (Event): Set by the worker once its initializer has run.
+		deadline (Value): time.monotonic() by which the worker must finish what
+			it is doing, 0 while it waits for a request. CLOCK_MONOTONIC is
+			system wide, so both processes can compare it.
+		cancelled (Array): Per slot flag, set by the parent when it stopped
+			waiting for the slot's request.
+		loadTimeout (float): Seconds the initializer may take.
+		snapshotInterval (float): Seconds between snapshots pushed by the worker.
+	'''
+
+	def __init__(self, context, slots, loadTimeout, snapshotInterval):
+		self.ready = context.Event()
+		self.deadline = context.Value('d', 0.0, lock=False)
+		self.cancelled = context.Array('b', slots, lock=False)
+		self.loadTimeout = loadTimeout
+		self.snapshotInterval = snapshotInterval
+
+	def Busy(self, timeout):
+		self.deadline.value = time.monotonic() + timeout
+
+	def Idle(self):
+		self.deadline.value = 0.0
+
+	def Hung(self):
+		deadline = self.deadline.value
+		return deadline > 0 and time.monotonic() > deadline
+
+
+def InferenceWorkerMain(ringName, slots, shape, requests, responses, handler, initializer, snapshot, control):
+	''' Request loop of the inference worker process.
+
+	Requests are (id, command, slot, args, timeout) tuples, None stops the
+	worker. The timeout only starts once the worker picks the request up, so
+	a request queued behind model loading is not failed for it, and a request
+	the parent stopped waiting for is skipped instead of run on a stale frame.
+	handler(command, image, *args) gets a private copy of the slot's input
+	frame as image, or None for commands without a frame: the parent reuses
+	the slot once it has the answer, while threads started by the handler
+	(e.g. the async YOLO detector) may still read the frame. An image returned
+	as the first element of a result tuple is written into the slot's output
+	frame instead of being pickled. Between requests, snapshot() is pushed
+	to the parent every snapshotInterval seconds with None as id.
+	'''
+	# the parent owns shutdown, Ctrl-C in the terminal must not kill the worker first
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	ring = SharedFrameRing(slots, shape, name=ringName)
+	try:
+		control.Busy(control.loadTimeout)
+		if initializer is not None:
+			initializer()
+		control.Idle()
+		control.ready.set()
+		lastSnapshot = 0
+		while True:
+			if snapshot is not None and time.monotonic() - lastSnapshot >= control.snapshotInterval:
+				try:
+					responses.put((None, True, snapshot(), False))
+				except Exception as e:
+					print("inference worker snapshot failed: " + repr(e))
+				lastSnapshot = time.monotonic()
+			try:
+				request = requests.get(timeout=control.snapshotInterval)
+			except queue.Empty:
+				continue
+			if request is None:
+				break
+			requestId, command, slot, args, timeout = request
+			if slot is not None and control.cancelled[slot]:
+				responses.put((requestId, False, "cancelled", False))
+				continue
+			control.Busy(timeout)
+			try:
+				image = ring.Slot(slot).copy() if slot is not None else None
+				result = handler(command, image, *args)
+				inSlot = False
+				if slot is not None and isinstance(result, tuple) and result and ring.Fits(result[0]):
+					np.copyto(ring.Output(slot), result[0])
+					result = (None,) + result[1:]
+					inSlot = True
+				responses.put((requestId, True, result, inSlot))
+			except Exception as e:
+				responses.put((requestId, False, repr(e), False))
+			finally:
+				control.Idle()
+	finally:
+		ring.Close()
+
+
+class PendingCall():
+	def __init__(self, slot):
+		self.slot = slot
+		self.event = threading.Event()
+		self.ok = False
+		self.result = None
+
+
+class InferenceProcess():
+	''' Runs the demo inference in a separate worker process.
+
+	Capture, GTK painting, the web server and the CAN notifier keep the GIL of
+	the main process, while the models and their Python pre/post-processing
+	run in the worker. Frames go to the worker through a SharedFrameRing,
+	requests and results through small queues, and the annotated frame comes
+	back through the output frame of the same slot.
+
+	The worker is spawned rather than forked: the parent has GTK, OpenCV and
+	its pipeline threads running, and a fork could inherit locks held by
+	them, while a restart must be as safe as the first start. handler,
+	initializer and snapshot are therefore pickled, they must be module level
+	functions (or functools.partial of them), and the main module is imported
+	again in the worker, so it must start the application under
+	if __name__ == "__main__". Until the initializer is done Ready() is False.
+
+	A worker that exits, or that spends longer than its timeout on a request
+	(loadTimeout for the initializer), is killed and restarted by the next
+	call; its pending calls fail.
+
+	Control commands that need no answer go through Send(), which does not
+	wait for the frames queued before them. Only Call() and EnsureRunning(),
+	made from the inference thread, start or restart the worker. State the UI or web server polls
+	(e.g. stats) should come from Snapshot() rather than a Call().
+
+	Args:
+		handler (callable): handler(command, image, *args) run in the worker
+			for every Call().
+		initializer (callable): Run once in the worker before any request.
+		snapshot (callable): Run in the worker every snapshotInterval seconds,
+			its last result is returned by Snapshot().
+		slots (int): Frames that can be in flight at once. Defaults to 4.
+		shape (tuple): Frame shape. Defaults to 240x320x3.
+		timeout (float): Seconds the worker may spend on a request. Defaults to 10.
+		loadTimeout (float): Seconds the worker may spend loading models, in the
+			initializer or a Call(..., loading=True). Defaults to 300.
+		snapshotInterval (float): Seconds between snapshots. Defaults to 1.
+
+	Attributes:
+		calls (int): Completed calls.
+		errors (int): Calls that raised in the worker or timed out.
+		restarts (int): Times the worker was restarted after it died or hung.
+		hangs (int): Times the worker was killed for exceeding its timeout.
+	'''
+
+	def __init__(self, handler, initializer = None, slots = 4, shape = FRAME_SHAPE, timeout = 10.0, loadTimeout = 300.0,
+				 snapshot = None, snapshotInterval = 1.0):
+		self.handler = handler
+		self.initializer = initializer
+		self.snapshot = snapshot
+		self.snapshotInterval = snapshotInterval
+		self.lastSnapshot = None
+		self.deferred = []
+		self.slots = slots
+		self.shape = tuple(shape)
+		self.timeout = timeout
+		self.loadTimeout = loadTimeout
+		self.context = multiprocessing.get_context("spawn")
+		self.process = None
+		self.control = None
+		self.ring = None
+		self.requests = None
+		self.responses = None
+		self.receiver = None
+		self.running = False
+		self.pending = {}
+		self.ids = itertools.count()
+		self.lock = threading.Lock()
+		self.startLock = threading.Lock()
+		self.calls = 0
+		self.errors = 0
+		self.restarts = 0
+		self.hangs = 0
+
+	def Start(self):
+		with self.startLock:
+			if self.running:
+				return
+			self.ring = SharedFrameRing(self.slots, self.shape)
+			self.control = WorkerControl(self.context, self.slots, self.loadTimeout, self.snapshotInterval)
+			# covers starting the interpreter until the worker takes over
+			self.control.Busy(self.loadTimeout)
+			self.requests = self.context.Queue()
+			self.responses = self.context.Queue()
+			self.process = self.context.Process(target=InferenceWorkerMain, name="inference-worker", daemon=True,
+												args=(self.ring.name, self.slots, self.shape, self.requests,
+													  self.responses, self.handler, self.initializer, self.snapshot, self.control))
+			self.process.start()
+			for request in self.deferred:
+				self.requests.put(request)
+			self.deferred = []
+			self.running = True
+			self.receiver = threading.Thread(target=self.Receive, name="inference-receiver", daemon=True)
+			self.receiver.start()
+
+	def Stop(self, timeout = 2):
+		with self.startLock:
+			if self.process is None:
+				return
+			self.running = False
+			if self.process.is_alive():
+				self.requests.put(None)
+				self.process.join(timeout)
+				if self.process.is_alive():
+					self.process.terminate()
+					self.process.join(timeout)
+			self.receiver.join(timeout)
+			self.FailPending("inference worker stopped")
+			self.requests.close()
+			self.responses.close()
+			self.ring.Close()
+			self.process = None
+
+	def Alive(self):
+		return self.running and self.process is not None and self.process.is_alive()
+
+	def EnsureRunning(self):
+		''' Starts the worker, or restarts it if it exited or was killed. '''
+		if not self.Alive():
+			if self.process is not None:
+				self.Stop()
+				self.restarts += 1
+			self.Start()
+
+	def Ready(self):
+		''' True once the worker is up and its initializer has run. '''
+		return self.Alive() and self.control.ready.is_set()
+
+	def Call(self, command, image = None, *args, loading = False):
+		''' Runs handler(command, image, *args) in the worker and returns its result.
+
+		Raises RuntimeError when the worker failed the call, TimeoutError when
+		it did not answer in time. A dead or hung worker is restarted first.
+		loading gives the call loadTimeout instead of timeout.
+		'''
+		self.EnsureRunning()
+
+		slot = None
+		if image is not None:
+			slot = self.ring.Acquire()
+			if slot is None:
+				raise RuntimeError("inference worker has no free frame slot")
+			self.control.cancelled[slot] = 0
+			self.ring.Write(slot, image)
+
+		timeout = self.loadTimeout if loading else self.timeout
+		pending = PendingCall(slot)
+		with self.lock:
+			requestId = next(self.ids)
+			self.pending[requestId] = pending
+		self.requests.put((requestId, command, slot, args, timeout))
+
+		# queued behind a request that is loading models the answer can take up
+		# to loadTimeout, a hung worker is killed by the receiver before that
+		if not pending.event.wait(timeout + self.loadTimeout):
+			# the worker skips the request, the receiver releases the slot when it does
+			if slot is not None:
+				self.control.cancelled[slot] = 1
+			with self.lock:
+				self.errors += 1
+			raise TimeoutError("inference worker did not answer " + command)
+		if not pending.ok:
+			with self.lock:
+				self.errors += 1
+			raise RuntimeError(pending.result)
+		with self.lock:
+			self.calls += 1
+		return pending.result
+
+	def Send(self, command, *args, loading = False):
+		''' Queues handler(command, None, *args) in the worker without waiting for it.
+
+		Failures are printed by the receiver. Send() never starts or restarts
+		the worker, so it is safe on the GTK and web threads: while the worker
+		is down the command is kept and queued first by the next Start().
+		'''
+		timeout = self.loadTimeout if loading else self.timeout
+		with self.lock:
+			requestId = next(self.ids)
+		request = (requestId, command, None, args, timeout)
+		with self.startLock:
+			if self.running and self.process.is_alive():
+				self.requests.put(request)
+			else:
+				self.deferred.append(request)
+
+	def Snapshot(self):
+		''' Last snapshot pushed by the worker, None before the first one. '''
+		return self.lastSnapshot
+
+	def Receive(self):
+		while self.running:
+			if self.control.Hung() and self.process.is_alive():
+				print("inference worker did not finish in time, restarting it")
+				self.hangs += 1
+				self.process.kill()
+			try:
+				response = self.responses.get(timeout=0.2)
+			except Exception:
+				if self.running and not self.process.is_alive():
+					self.FailPending("inference worker exited with code {}".format(self.process.exitcode))
+				continue
+
+			requestId, ok, result, inSlot = response
+			if requestId is None:
+				self.lastSnapshot = result
+				continue
+			with self.lock:
+				pending = self.pending.pop(requestId, None)
+			if pending is None:
+				if not ok and result != "cancelled":
+					# a Send() failed, nobody waits for it
+					print("inference worker request failed: " + result)
+				continue
+			if inSlot:
+				result = (self.ring.Output(pending.slot).copy(),) + result[1:]
+			if pending.slot is not None:
+				self.ring.Release(pending.slot)
+			pending.ok = ok
+			pending.result = result
+			pending.event.set()
+
+	def FailPending(self, reason):
+		with self.lock:
+			pending, self.pending = self.pending, {}
+		for call in pending.values():
+			# the worker is gone, nobody will write to these slots any more
+			if call.slot is not None:
+				self.ring.Release(call.slot)
+			call.result = reason
+			call.event.set()
+
+	def stats(self):
+		with self.lock:
+			inFlight = len(self.pending)
+			calls, errors = self.calls, self.errors
+		return {
+			"alive": self.Alive(),
+			"ready": self.Ready(),
+			"pid": self.process.pid if self.process is not None else None,
+			"calls": calls,
+			"errors": errors,
+			"restarts": self.restarts,
+			"hangs": self.hangs,
+			"in_flight": inFlight,
+			"free_slots": self.ring.FreeSlots() if self.ring is not None else 0,
+		}
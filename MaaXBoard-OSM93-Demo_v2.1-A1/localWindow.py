@@ -9,11 +9,15 @@ from math import pi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, Gdk, GLib, GdkPixbuf
 from CanTools.car_attributes_handler import CarAttributesHandler
+from dms.inference_timer import InferenceTimeLogger
+from frame_views import FrameViews
 
 
 scriptFolder = os.path.dirname(__file__)
 layoutPath = "resources/mainApp.glade"
 globalFrame = None
+globalFrameViews = None
+globalCaptureTime = None
 cameraOpen = False
 activeDemo = 0
 carSpeed = 0
@@ -21,7 +25,10 @@ carSpeed = 0
 GladeBuilder = Gtk.Builder()
 
 class localWindow():
-	def __init__(self, callback = None):
+	def __init__(self, callback = None, latency = None, inferenceStats = None):
+		self.latency = latency
+		# model timing stats, e.g. cameraSupport.GetInferenceStats which reads them from the inference worker
+		self.inferenceStats = inferenceStats
 		self.eventHandler = self.Handler(self)
 		self.running = True
 		self.frame = None
@@ -51,11 +58,16 @@ class localWindow():
 		self.loaclAppThread = threading.Thread(target=self.localApp)
 		self.loaclAppThread.start()
 
-	def updateFrame(self,frame):
+	def updateFrame(self,frame, captureTime = None):
 		global globalFrame
+		global globalFrameViews
+		global globalCaptureTime
 		global cameraOpen
 
 		globalFrame = frame
+		# the widget repaints continuously, convert each frame for display only once
+		globalFrameViews = FrameViews(frame)
+		globalCaptureTime = captureTime
 		cameraOpen = True
 
 	def UpdateActiveDemo(self, demoIndex):
@@ -165,6 +177,8 @@ class localWindow():
 		if (self.inference_speed != inference_speed):
 			label4_text = '<span weight="bold" size="xx-large">{}</span>'.format(str(inference_speed + " ms"))
 			label4.set_markup(label4_text)
+			stats = self.inferenceStats() if self.inferenceStats is not None else None
+			label4.set_tooltip_text(InferenceTimeLogger().summary(stats))
 			self.inference_speed = inference_speed
 
 		if (self.penalty_score != penalty_image):
@@ -265,6 +279,8 @@ class localWindow():
 		
 		def CapImage_event(self, widget, context):
 			global globalFrame
+			global globalFrameViews
+			global globalCaptureTime
 			global cameraOpen
 			global activeDemo
 			global carSpeed
@@ -305,12 +321,8 @@ class localWindow():
 				context.paint()
 
 			elif cameraOpen:
-				frame = globalFrame[:, ::-1, :]
-				height, width, _ = frame.shape # 240, 320
-				margin_y, margin_x = int(height/4), int(width/4) # 60, 80
-				center_y, center_x = int(height/2), int(width/2) # 120, 160
-				frame = frame[margin_y:center_y+margin_y, margin_x:center_x+margin_x]
-				frame = cv2.cvtColor(frame[:,:,::-1], cv2.COLOR_BGR2RGBA).astype('uint8')
+				# mirrored center crop (60:180, 80:240 of 240x320) as ARGB32
+				frame = globalFrameViews.DisplayRGBA()
 				H, W, C = frame.shape
 				surface = cairo.ImageSurface.create_for_data(frame, cairo.FORMAT_ARGB32, W, H)
 				CWidth = widget.get_allocation().width
@@ -325,6 +337,11 @@ class localWindow():
 					context.set_source_surface(surface, (W-CWidth)/2, 0)
 				context.rotate (pi/2)
 				context.paint()
+
+				# only the first paint of each frame counts towards display latency
+				if globalCaptureTime is not None and self.outer_instance.latency is not None:
+					self.outer_instance.latency.Record("display", globalCaptureTime)
+					globalCaptureTime = None
 			widget.queue_draw()
 
 		def reset_button_clicked_cb(self, widget):
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import cv2
+
+
+class MJPEGPublisher():
+	''' Encode-once JPEG publisher shared by all /video_feed clients.
+
+	Frames handed to publish() are numbered and encoded at most once, on a
+	single encoder thread, and only while at least one client is streaming.
+	The finished multipart chunk is kept in a shared buffer and streaming
+	clients are woken through an asyncio.Event when a new one is available.
+
+	Args:
+		quality (int): JPEG quality (0-100). Defaults to OpenCV's default.
+		latency (LatencyTracker): Records capture-to-encoded latency as "mjpeg".
+
+	Attributes:
+		seq (int): Sequence number of the last encoded frame.
+		handledSeq (int): Sequence number of the last frame the encoder took,
+			whether or not it could be encoded.
+		chunk (bytes): Last encoded frame wrapped as a multipart/x-mixed-replace part.
+		encodedFrames (int): Total number of JPEG encodes performed.
+	'''
+
+	BOUNDARY = b'--frame\r\n'
+
+	def __init__(self, quality = None, latency = None):
+		self.params = [int(cv2.IMWRITE_JPEG_QUALITY), quality] if quality is not None else []
+		self.latency = latency
+		self.condition = threading.Condition()
+		self.rawFrame = None
+		self.rawCaptureTime = None
+		self.rawSeq = 0
+		self.seq = 0
+		self.handledSeq = 0
+		self.chunk = None
+		self.encodedFrames = 0
+		self.clients = set()
+		self.running = True
+		self.encoderThread = threading.Thread(target=self.encoder, name="mjpeg-encoder", daemon=True)
+		self.encoderThread.start()
+
+	def publish(self, frame, captureTime = None):
+		''' Hands a new BGR frame to the encoder. Never blocks on encoding. '''
+		with self.condition:
+			self.rawFrame = frame
+			self.rawCaptureTime = captureTime
+			self.rawSeq += 1
+			self.condition.notify()
+
+	def close(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify_all()
+			clients = list(self.clients)
+		# wake the streaming clients so their generators see running is False
+		self.wake(clients)
+
+	def latest(self):
+		with self.condition:
+			return self.seq, self.chunk
+
+	def subscribe(self):
+		''' Registers the calling coroutine's loop and returns its wake-up event. '''
+		client = (asyncio.get_running_loop(), asyncio.Event())
+		with self.condition:
+			self.clients.add(client)
+			if self.chunk is not None:
+				client[1].set()
+			self.condition.notify()
+		return client
+
+	def unsubscribe(self, client):
+		with self.condition:
+			self.clients.discard(client)
+
+	def pending(self):
+		return self.running and self.clients and self.rawSeq != self.handledSeq and self.rawFrame is not None
+
+	def wake(self, clients):
+		for loop, event in clients:
+			try:
+				loop.call_soon_threadsafe(event.set)
+			except RuntimeError:
+				# client loop already closed
+				self.unsubscribe((loop, event))
+
+	def encoder(self):
+		while True:
+			with self.condition:
+				self.condition.wait_for(lambda: not self.running or self.pending())
+				if not self.running:
+					return
+				frame, seq, captureTime = self.rawFrame, self.rawSeq, self.rawCaptureTime
+				# a frame that fails to encode is not retried until a new one arrives
+				self.handledSeq = seq
+
+			try:
+				ret, jpeg = cv2.imencode('.JPEG', frame, self.params)
+			except cv2.error:
+				ret = False
+			if not ret:
+				continue
+			chunk = b''.join((self.BOUNDARY, b'Content-Type: image/jpeg\r\n\r\n', jpeg.tobytes(), b'\r\n'))
+
+			with self.condition:
+				self.seq = seq
+				self.chunk = chunk
+				self.encodedFrames += 1
+				clients = list(self.clients)
+			if self.latency is not None:
+				self.latency.Record("mjpeg", captureTime)
+
+			self.wake(clients)
+
+	async def stream(self):
+		''' Async generator yielding each newly encoded multipart chunk once. '''
+		client = self.subscribe()
+		event = client[1]
+		lastSeq = None
+		try:
+			yield self.BOUNDARY
+			while self.running:
+				await event.wait()
+				event.clear()
+				seq, chunk = self.latest()
+				if chunk is not None and seq != lastSeq:
+					lastSeq = seq
+					yield chunk
+		finally:
+			self.unsubscribe(client)
@@ -0,0 +1,81 @@
+import time
+import threading
+import cv2
+import numpy as np
+
+
+class MotionGate():
+	''' Cheap scene change detector that lets static frames reuse the last result.
+
+	Each frame is reduced to a tiny grayscale thumbnail. When it differs from the
+	thumbnail of the frame the cached result was computed on by less than the
+	threshold (mean absolute difference, 0-255), the cached result is reused
+	instead of running the models again. A result is never reused for longer
+	than maxAge, so slow changes and time based scores (e.g. the DMS penalty)
+	still get refreshed.
+
+	Args:
+		threshold (float): Mean absolute thumbnail difference that counts as a
+			change. None disables the gate. Defaults to 2.0.
+		maxAge (float): Max seconds a result is reused. Defaults to 0.5.
+		size (tuple): Thumbnail (width, height). Defaults to (32, 24).
+
+	Attributes:
+		frames (dict): Frames seen per key.
+		skipped (dict): Frames that reused a result per key.
+	'''
+
+	def __init__(self, threshold = 2.0, maxAge = 0.5, size = (32, 24)):
+		self.threshold = threshold
+		self.maxAge = maxAge
+		self.size = size
+		self.entries = {}
+		self.frames = {}
+		self.skipped = {}
+		self.lock = threading.Lock()
+
+	def Signature(self, image):
+		small = cv2.resize(image, self.size, interpolation=cv2.INTER_AREA)
+		if small.ndim == 3:
+			small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+		return small.astype(np.int16)
+
+	def Lookup(self, key, signature):
+		''' Returns the cached result of key if the scene has not changed, else None. '''
+		with self.lock:
+			self.frames[key] = self.frames.get(key, 0) + 1
+			if self.threshold is None:
+				return None
+			entry = self.entries.get(key)
+			if entry is None:
+				return None
+			reference, result, resultTime = entry
+			if time.monotonic() - resultTime > self.maxAge:
+				return None
+			if np.abs(signature - reference).mean() > self.threshold:
+				return None
+			self.skipped[key] = self.skipped.get(key, 0) + 1
+			return result
+
+	def Store(self, key, signature, result):
+		with self.lock:
+			self.entries[key] = (signature, result, time.monotonic())
+
+	def Reset(self, key = None):
+		''' Drops cached results, e.g. after the demo or backend changed. '''
+		with self.lock:
+			if key is None:
+				self.entries.clear()
+			else:
+				self.entries.pop(key, None)
+
+	def stats(self):
+		with self.lock:
+			return {
+				str(key): {
+					"frames": frames,
+					"skipped": self.skipped.get(key, 0),
+					"skip_ratio": round(self.skipped.get(key, 0) / frames, 3) if frames else 0.0,
+				}
+				for key, frames in self.frames.items()
+			}
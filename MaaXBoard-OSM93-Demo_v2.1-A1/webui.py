@@ -17,7 +17,10 @@ import json
 import cv2
 from netinfo import NETInfo
 from camera import cameraSupport
+from frame_source import CreateFrameSource
 from localWindow import localWindow
+from mjpeg_publisher import MJPEGPublisher
+from frame_pipeline import LatencyTracker
 from tendo import singleton
 from CanTools.car_status import CarStatus
 from CanTools.can_main import CanDemoManager
@@ -49,6 +52,32 @@ else:
 	RotateCameraX = True
 	EnableUSBPowerMonitor = True
 
+'''
+Frame source for the camera demos: "v4l2" (default), "v4l2:<index>", "synthetic",
+an image directory or a video file, e.g. FRAME_SOURCE=web/sample.mp4 to run
+without a camera. FRAME_SOURCE_FPS overrides the source's frame rate.
+'''
+FrameSourceSpec = os.environ.get('FRAME_SOURCE', 'v4l2')
+FrameSourceFPS = float(os.environ['FRAME_SOURCE_FPS']) if 'FRAME_SOURCE_FPS' in os.environ else None
+
+'''
+LOW_LATENCY_CAPTURE=1 opens the camera at 320x240 (or the smallest mode above
+it) with a single driver buffer, decoding only frames inference can take,
+instead of capturing 640x480 and downscaling.
+'''
+LowLatencyCapture = os.environ.get('LOW_LATENCY_CAPTURE', '0') == '1'
+
+'''
+Frames older than LATENCY_BUDGET_MS (capture to stage) are dropped by the
+pipeline instead of processed. Unset to never drop.
+'''
+LatencyBudget = float(os.environ['LATENCY_BUDGET_MS']) / 1000 if 'LATENCY_BUDGET_MS' in os.environ else None
+
+'''
+INFERENCE_PROCESS=1 runs the DMS and fitness models in a worker process, so they
+do not compete with the UI, web server and CAN notifier for the GIL.
+'''
+InferenceProcessEnabled = os.environ.get('INFERENCE_PROCESS', '0') == '1'
 
 
 # Constants
@@ -57,10 +86,6 @@ DEMO_DMS = 1
 DEMO_CAN = 2
 
 
-# will sys.exit(-1) if other instance is running
-me = singleton.SingleInstance()
-
-
 seed(1)
 
 serialPortBusy = False
@@ -69,9 +94,6 @@ ledStates = [0, 0, 0]
 globalFrame = None
 globalCurrentDemo = 0
 
-# Setup Car simulator & can tools
-can_app_manager = CanDemoManager(selectedDemo=globalCurrentDemo)
-
 fileDir = os.path.dirname(os.path.realpath(__file__))
 
 def GetFileFullPath(s):
@@ -79,7 +101,7 @@ def GetFileFullPath(s):
 	filePath = os.path.abspath(os.path.realpath(filePath))
 	return filePath
 
-def frameCallback(frame, demoNumber, ret1, ret2, ret3, ret4, ret5, ret6):
+def frameCallback(frame, demoNumber, ret1, ret2, ret3, ret4, ret5, ret6, captureTime=None):
 	"""
     Callback function for processing frames from the camera.
 
@@ -89,6 +111,7 @@ def frameCallback(frame, demoNumber, ret1, ret2, ret3, ret4, ret5, ret6):
         frame (np.array): The latest frame from the camera.
         demoNumber (int): The identifier for the current demo.
         ret1, ret2, ret3, ret4, ret5 (int): Demo-specific return values for UI updates.
+        captureTime (float): time.monotonic() when the frame was captured.
 
     Returns:
         None
@@ -97,7 +120,9 @@ def frameCallback(frame, demoNumber, ret1, ret2, ret3, ret4, ret5, ret6):
 	global globalCurrentDemo
 
 	globalFrame = frame
-	window.updateFrame(frame)
+	latency.Record("callback", captureTime)
+	mjpeg_publisher.publish(frame, captureTime)
+	window.updateFrame(frame, captureTime)
 
 	if (globalCurrentDemo == DEMO_FITNESS) and (demoNumber == DEMO_FITNESS):
 		window.UpdateFitnessUI(ret1, ret2, ret3, ret4)
@@ -154,21 +179,10 @@ app = Microdot()
 
 @app.route('/video_feed')
 async def video_feed(request):
-	global usingClip
-	global globalFrame
 	if sys.implementation.name != 'micropython':
-		# CPython supports yielding async generators
-		async def stream():
-			yield b'--frame\r\n'
-			while True:
-				if camera.CameraOpen():
-					frame = globalFrame
-					if(frame is not None):
-						_, frame = cv2.imencode('.JPEG', frame)
-						yield (b'--frame\r\n'
-							b'Content-Type: image/jpeg\r\n\r\n' + frame.tobytes() + b'\r\n')
-
-				await asyncio.sleep(0.01)
+		# CPython supports yielding async generators, frames are encoded
+		# once by the shared publisher and clients only wake on a new frame
+		stream = mjpeg_publisher.stream
 
 	else:
 		# MicroPython can only use class-based async generators
@@ -198,6 +212,37 @@ async def ethernet(request):
 		response = sys_cookie
 	return response
 
+@app.route('/metrics.cgi', methods=['GET'])
+async def metrics(request):
+	response = None
+	if request.method == 'GET':
+		cmdType = 'metrics'
+		data_set = {"cmdType": cmdType, "models": camera.GetInferenceStats(), "backends": camera.GetDMSBackendStats()}
+
+		response = json.dumps(data_set)
+	return response
+
+@app.route('/latency.cgi', methods=['GET'])
+async def latencyCgi(request):
+	response = None
+	if request.method == 'GET':
+		cmdType = 'latency'
+		data_set = {"cmdType": cmdType, "latency": camera.GetLatencyStats()}
+
+		response = json.dumps(data_set)
+	return response
+
+@app.route('/pipeline.cgi', methods=['GET'])
+async def pipeline(request):
+	response = None
+	if request.method == 'GET':
+		cmdType = 'pipeline'
+		data_set = {"cmdType": cmdType, "stages": camera.GetPipelineStats(), "motion_gate": camera.GetMotionGateStats(),
+					"inference_process": camera.GetInferenceProcessStats()}
+
+		response = json.dumps(data_set)
+	return response
+
 @app.route('/uses/rundemo.cgi', methods=['GET', 'POST'])
 def demoCgi(request):
 	if request.method == 'POST':
@@ -236,10 +281,29 @@ def index(request):
 
 	return response
 
-camera = cameraSupport(HardwareSupport, frameCallback)
+# The inference worker processes are spawned and import this module again as
+# __mp_main__, only the application itself must not start there.
+if __name__ == "__main__":
+	# will sys.exit(-1) if other instance is running
+	me = singleton.SingleInstance()
+
+	# Capture-to-consumer latency of camera frames, shared by all consumers
+	latency = LatencyTracker(LatencyBudget)
+
+	# Single JPEG encoder shared by every /video_feed client
+	mjpeg_publisher = MJPEGPublisher(latency=latency)
+
+	# Setup Car simulator & can tools
+	can_app_manager = CanDemoManager(selectedDemo=globalCurrentDemo)
+
+	camera = cameraSupport(HardwareSupport, frameCallback,
+						   CreateFrameSource(FrameSourceSpec, fps=FrameSourceFPS, onHardware=HardwareSupport,
+											 lowLatency=LowLatencyCapture),
+						   latency, inferenceProcess=InferenceProcessEnabled)
 
-window = localWindow(screenClickCallback)
+	window = localWindow(screenClickCallback, latency, camera.GetInferenceStats)
 
-app.run(debug=True)
+	app.run(debug=True)
 
-camera.close()
+	camera.close()
+	mjpeg_publisher.close()